@@ -0,0 +1,5 @@
+"""
+Benchmarks of powny-cli hot paths against a local stand-in of Powny API.
+
+Run `python -m benchmarks --output results.json` from the repository root.
+"""
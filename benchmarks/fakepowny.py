@@ -0,0 +1,245 @@
+"""
+Local stand-in for Powny API and the Elasticsearch with job logs.
+
+The server runs in a separate process, so it doesn't compete with the measured client for the GIL.
+Responses have the same shape as the real ones and large bodies are encoded once,
+so the benchmarks measure the client side.
+"""
+
+import json
+import random
+import uuid
+import multiprocessing
+from datetime import datetime, timedelta
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+from urllib.parse import urlsplit, parse_qs
+
+LOG_LEVELS = ('INFO', 'DEBUG', 'WARNING', 'INFO', 'ERROR')
+JOB_ID = '3c957a26-cb47-47ee-ad75-d729a211bd29'
+
+
+def make_jobs(count: int, base_url: str):
+    jobs = {}
+    created = datetime(2015, 1, 1)
+    for number in range(count):
+        job_id = str(uuid.UUID(int=number))
+        jobs[job_id] = {
+            'url': '{}/v1/jobs/{}'.format(base_url, job_id),
+            'method': 'rules.bench_{:03d}.on_event_{}'.format(number % 50, number % 10),
+            'number': number,
+            'created': (created + timedelta(seconds=number)).strftime('%Y-%m-%d %H:%M:%S.%fZ'),
+            'taken': False,
+            'finished': None,
+        }
+    return jobs
+
+
+def make_hits(count: int, job_id=JOB_ID):
+    """Log records of the job in the order of relevance, i.e. not sorted by time"""
+    started = datetime(2015, 1, 1)
+    hits = []
+    for number in range(count):
+        hits.append({
+            '_index': 'logstash-2015.01.01',
+            '_type': 'powny',
+            '_id': str(number),
+            '_source': {
+                '@timestamp': (started + timedelta(milliseconds=number * 10)).strftime('%Y-%m-%dT%H:%M:%S.%f'),
+                'job_id': job_id,
+                'level': LOG_LEVELS[number % len(LOG_LEVELS)],
+                'node': 'node{:02d}-worker'.format(number % 5),
+                'msg': 'Step %d of the job %s',
+                'args': [number, job_id],
+            },
+        })
+    random.Random(0).shuffle(hits)
+    return hits
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately, with Nagle's algorithm each response would wait for delayed ACK
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def _send_body(self, body: bytes, status=200, headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for (name, value) in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_result(self, result, message='', status=200, headers=None):
+        body = json.dumps({'status': 'ok' if status < 400 else 'error', 'message': message, 'result': result})
+        self._send_body(body.encode(), status, headers)
+
+    def _read_json(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length)
+        return json.loads(body.decode()) if body else {}
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        url = urlsplit(self.path)
+        state = self.server.state
+        if url.path == '/v1/jobs':
+            self._send_body(state.get_jobs_body())
+        elif url.path.startswith('/v1/jobs/'):
+            job = state.jobs.get(url.path.rsplit('/', 1)[1])
+            if job is None:
+                self._send_result(None, 'Job not found', status=404)
+            else:
+                self._send_result(job, 'The job info')
+        elif url.path == '/v1/rules':
+            self._send_result({'head': state.head, 'errors': {}, 'exposed': {'handlers': [], 'methods': []}})
+        elif url.path == '/v1/system/state':
+            self._send_result(state.system_state, 'The system statistics')
+        elif url.path == '/v1/system/config':
+            if self.headers.get('If-None-Match') == state.config_etag:
+                self._send_body(b'', status=304, headers={'ETag': state.config_etag})
+            else:
+                self._send_result(state.cluster_config, 'The configuration', headers={'ETag': state.config_etag})
+        elif url.path == '/v1/system/info':
+            self._send_result({'version': '1.0.0'})
+        elif url.path == '/_search/scroll':
+            scroll_id = parse_qs(url.query)['scroll_id'][0]
+            self._send_body(state.scroll(scroll_id))
+        elif url.path.endswith('/_search'):
+            size = int(parse_qs(url.query).get('size', ['10'])[0])
+            self._send_body(state.get_search_body(size))
+        else:
+            self._send_result(None, 'Not found', status=404)
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        url = urlsplit(self.path)
+        state = self.server.state
+        data = self._read_json()
+        if url.path == '/v1/jobs':
+            job_id = str(uuid.uuid4())
+            self._send_result({job_id: {'url': '{}/v1/jobs/{}'.format(state.base_url, job_id),
+                                        'method': 'rules.bench_000.on_event_0'}}, 'Handlers were launched')
+        elif url.path == '/v1/rules':
+            state.head = data.get('head')
+            self._send_result({'head': state.head}, 'The HEAD has been updated')
+        elif url.path.endswith('/_search'):
+            size = int(data.get('size', 10))
+            if 'scroll' in parse_qs(url.query):
+                self._send_body(state.start_scroll(size))
+            else:
+                self._send_body(state.get_search_body(size))
+        else:
+            self._send_result(None, 'Not found', status=404)
+
+    def do_DELETE(self):  # pylint: disable=invalid-name
+        path = urlsplit(self.path).path
+        if path == '/_search/scroll':
+            for scroll_id in self._read_json().get('scroll_id', []):
+                self.server.state.scrolls.pop(scroll_id, None)
+            self._send_body(b'{"succeeded": true}')
+            return
+        job_id = path.rsplit('/', 1)[1]
+        if job_id in self.server.state.jobs:
+            self._send_result({'deleted': job_id}, 'The job has been removed')
+        else:
+            self._send_result(None, 'Job not found', status=404)
+
+
+class _State:
+    def __init__(self, base_url: str, jobs: int, hits: int):
+        self.base_url = base_url
+        self.jobs = make_jobs(jobs, base_url)
+        self.hits = make_hits(hits)
+        self.head = None
+        self.cluster_config = {'core': {'backend': 'local'}, 'backend': {}}
+        self.config_etag = '"bench-config"'
+        self.system_state = {'apps': {'node01': {'collector': {'host': {'node': 'node01', 'fqdn': 'localhost'},
+                                                               'when': '2015-01-01 00:00:00.000000Z',
+                                                               'state': {'processed': 1, 'respawns': 0}}}},
+                             'jobs': {'input': 0, 'all': jobs}}
+        self.scrolls = {}  # Scroll id -> (offset of the next page, page size)
+        self._sorted_hits = sorted(self.hits, key=lambda hit: hit['_source']['@timestamp'])
+        self._jobs_body = None
+        self._search_bodies = {}
+        self._page_bodies = {}
+
+    def get_jobs_body(self):
+        if self._jobs_body is None:
+            jobs = {job_id: {'url': job['url']} for (job_id, job) in self.jobs.items()}
+            self._jobs_body = json.dumps({'status': 'ok', 'message': 'The list with all jobs',
+                                          'result': jobs}).encode()
+        return self._jobs_body
+
+    def get_search_body(self, size: int):
+        if size not in self._search_bodies:
+            hits = self.hits[:size]
+            self._search_bodies[size] = json.dumps({'took': 1, 'timed_out': False,
+                                                    'hits': {'total': len(self.hits), 'hits': hits}}).encode()
+        return self._search_bodies[size]
+
+    def _get_page_body(self, scroll_id: str, offset: int, size: int):
+        key = (offset, size)
+        if key not in self._page_bodies:
+            self._page_bodies[key] = json.dumps({'took': 1, 'timed_out': False, '_scroll_id': '{scroll_id}',
+                                                 'hits': {'total': len(self.hits),
+                                                          'hits': self._sorted_hits[offset:offset + size]}})
+        # Pages are encoded once, only the scroll id is substituted
+        return self._page_bodies[key].replace('{scroll_id}', scroll_id, 1).encode()
+
+    def start_scroll(self, size: int):
+        scroll_id = str(uuid.uuid4())
+        self.scrolls[scroll_id] = (size, size)
+        return self._get_page_body(scroll_id, 0, size)
+
+    def scroll(self, scroll_id: str):
+        offset, size = self.scrolls.get(scroll_id, (len(self.hits), 0))
+        self.scrolls[scroll_id] = (offset + size, size)
+        return self._get_page_body(scroll_id, offset, size)
+
+
+def _serve(connection, jobs: int, hits: int):
+    server = _Server(('127.0.0.1', 0), _Handler)
+    base_url = 'http://127.0.0.1:{}'.format(server.server_address[1])
+    server.state = _State(base_url, jobs, hits)
+    connection.send(base_url)
+    server.serve_forever()
+
+
+class FakePowny:
+    """
+    Context manager running the server with `jobs` jobs in the jobs table and `hits` log records of a job.
+    `url` is the base URL both for Powny API and Elasticsearch.
+    """
+
+    def __init__(self, jobs=0, hits=0):
+        self.jobs = jobs
+        self.hits = hits
+        self.url = None
+        self._process = None
+
+    def start(self):
+        parent, child = multiprocessing.Pipe()
+        self._process = multiprocessing.Process(target=_serve, args=(child, self.jobs, self.hits), daemon=True)
+        self._process.start()
+        self.url = parent.recv()
+        return self.url
+
+    def stop(self):
+        if self._process is not None:
+            self._process.terminate()
+            self._process.join()
+            self._process = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
@@ -0,0 +1,58 @@
+"""
+Synthetic Powny rules repository.
+
+Handlers are spread over modules of `HANDLERS_PER_MODULE` and match events by different fields,
+so every generated event is matched by a few handlers.
+"""
+
+import os
+import json
+import subprocess
+
+HANDLERS_PER_MODULE = 10
+
+_HANDLER = '''
+@expose
+@on_event
+@match_event(lambda event: event['{field}'] == {value!r})
+def on_event_{number}(**event):
+    return len(event['description'])
+'''
+
+
+def _get_condition(number: int):
+    if number % 3 == 0:
+        return 'host', 'host{:04d}'.format(number)
+    elif number % 3 == 1:
+        return 'service', 'service{:04d}'.format(number)
+    return 'status', ('OK', 'WARN', 'CRIT')[number % 9 // 3]
+
+
+def make_rules_repo(path: str, handlers: int, settings: dict):
+    """Create git repository with `handlers` handlers and `pownyrules.yaml` made of `settings`"""
+    rules_dir = os.path.join(path, 'rules')
+    os.makedirs(rules_dir)
+    with open(os.path.join(rules_dir, '__init__.py'), 'w'):
+        pass
+    for module in range(0, handlers, HANDLERS_PER_MODULE):
+        with open(os.path.join(rules_dir, 'bench_{:03d}.py'.format(module // HANDLERS_PER_MODULE)), 'w') as source:
+            source.write('from powny.core import expose, on_event, match_event\n\n')
+            for number in range(module, min(module + HANDLERS_PER_MODULE, handlers)):
+                field, value = _get_condition(number)
+                source.write(_HANDLER.format(field=field, value=value, number=number))
+    with open(os.path.join(path, 'pownyrules.yaml'), 'w') as config_file:
+        json.dump(settings, config_file)  # JSON is valid YAML
+
+    for command in (['init', '-q'], ['add', '.'], ['commit', '-q', '-m', 'Synthetic rules']):
+        subprocess.check_call(['git', '-c', 'user.name=bench', '-c', 'user.email=bench@localhost'] + command,
+                              cwd=path)
+    return path
+
+
+def make_events(count: int, handlers: int):
+    """Events matching the handlers of `make_rules_repo()` in turn"""
+    for number in range(count):
+        yield {'host': 'host{:04d}'.format(number % max(handlers, 1)),
+               'service': 'service{:04d}'.format((number + 1) % max(handlers, 1)),
+               'status': ('OK', 'WARN', 'CRIT')[number % 3],
+               'description': 'Synthetic event {}'.format(number)}
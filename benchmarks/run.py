@@ -0,0 +1,214 @@
+"""
+Scenarios measuring powny-cli commands against `FakePowny`.
+
+HTTP commands are invoked in-process through click's test runner, so the time is the time of the command itself.
+`rules exec` can initialize Powny only once per process, so it is run as a subprocess with two amounts
+of events: the difference excludes the start and the rules loading from the events rate.
+`startup` runs cheap commands as subprocesses, it is mostly the time of the interpreter start and imports.
+"""
+
+import os
+import sys
+import json
+import time
+import platform
+import shutil
+import tempfile
+import subprocess
+import click
+from datetime import datetime
+from click.testing import CliRunner
+import pownycli
+from benchmarks.fakepowny import FakePowny, JOB_ID
+from benchmarks.rulesrepo import make_rules_repo, make_events
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Logs are not a part of the measured work
+_CONFIG = {
+    'logging': {'version': 1, 'disable_existing_loggers': False, 'root': {'level': 'WARNING', 'handlers': []}},
+    'cache': {'cluster_config_ttl': 3600, 'rules_bytecode': True},
+}
+
+
+class BenchmarkError(Exception):
+    pass
+
+
+def _summary(samples):
+    samples = sorted(samples)
+    return {
+        'min': samples[0],
+        'median': samples[len(samples) // 2],
+        'p95': samples[min(len(samples) - 1, int(len(samples) * 0.95))],
+        'max': samples[-1],
+        'mean': sum(samples) / len(samples),
+    }
+
+
+class _Workspace:
+    """Temporary HOME, rules repository and config for one scenario"""
+
+    def __init__(self, tmp_dir: str, powny_url: str, handlers=0):
+        self.tmp_dir = tmp_dir
+        self.config_path = os.path.join(tmp_dir, 'config.yaml')
+        with open(self.config_path, 'w') as config_file:
+            json.dump(_CONFIG, config_file)
+        self.repo_path = make_rules_repo(os.path.join(tmp_dir, 'rules'), handlers,
+                                         {'powny_api_url': powny_url, 'elastic_url': powny_url})
+
+    def write_events(self, name: str, count: int, handlers: int):
+        path = os.path.join(self.tmp_dir, name)
+        with open(path, 'w') as events_file:
+            for event in make_events(count, handlers):
+                events_file.write(json.dumps(event) + '\n')
+        return path
+
+    def get_args(self, *args):
+        return ['-w', self.repo_path, '-c', self.config_path] + list(args)
+
+
+def _invoke(workspace, *args):
+    from pownycli import client
+    started = time.perf_counter()
+    result = CliRunner().invoke(client.cli, workspace.get_args(*args), catch_exceptions=False)
+    elapsed = time.perf_counter() - started
+    if result.exit_code != 0:
+        raise BenchmarkError("`powny {}` failed: {}".format(' '.join(args), result.output))
+    return elapsed
+
+
+def bench_send_event(tmp_dir, repeat: int, events: int, concurrency):
+    results = []
+    with FakePowny() as powny:
+        workspace = _Workspace(tmp_dir, powny.url)
+        events_path = workspace.write_events('send-events.json', events, 1)
+        for level in concurrency:
+            samples = [_invoke(workspace, 'job', 'send-event', '--file', events_path, '--concurrency', str(level))
+                       for _ in range(repeat)]
+            results.append({
+                'name': 'send_event',
+                'params': {'events': events, 'concurrency': level},
+                'metrics': dict(_summary(samples), events_per_sec=events / min(samples)),
+            })
+    return results
+
+
+def bench_job_list(tmp_dir, repeat: int, jobs: int):
+    with FakePowny(jobs=jobs) as powny:
+        workspace = _Workspace(tmp_dir, powny.url)
+        _invoke(workspace, 'job', 'list')  # Warm up the connection
+        samples = [_invoke(workspace, 'job', 'list') for _ in range(repeat)]
+    return [{'name': 'job_list', 'params': {'jobs': jobs}, 'metrics': _summary(samples)}]
+
+
+def bench_job_logs(tmp_dir, repeat: int, hits: int):
+    with FakePowny(hits=hits) as powny:
+        workspace = _Workspace(tmp_dir, powny.url)
+        args = ('job', 'logs', JOB_ID, '--size', str(hits))
+        _invoke(workspace, *args)
+        samples = [_invoke(workspace, *args) for _ in range(repeat)]
+    return [{'name': 'job_logs', 'params': {'hits': hits},
+             'metrics': dict(_summary(samples), hits_per_sec=hits / min(samples))}]
+
+
+def _run_process(workspace, *args):
+    env = dict(os.environ, HOME=workspace.tmp_dir,
+               PYTHONPATH=os.pathsep.join([ROOT_DIR] + sys.path))
+    started = time.perf_counter()
+    process = subprocess.Popen([sys.executable, '-m', 'pownycli.client'] + list(args), env=env, cwd=ROOT_DIR,
+                               stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    output = process.communicate()[0]
+    elapsed = time.perf_counter() - started
+    if process.returncode != 0:
+        raise BenchmarkError("`powny {}` failed: {}".format(' '.join(args), output.decode(errors='replace')))
+    return elapsed
+
+
+def _run_rules_exec(workspace, events_path, index: bool):
+    return _run_process(workspace, *workspace.get_args('rules', 'exec', '-e', events_path,
+                                                       '--index' if index else '--no-index'))
+
+
+def bench_rules_exec(tmp_dir, repeat: int, events: int, handlers: int):
+    results = []
+    with FakePowny() as powny:
+        workspace = _Workspace(tmp_dir, powny.url, handlers)
+        few_path = workspace.write_events('few-events.json', 1, handlers)
+        many_path = workspace.write_events('many-events.json', events + 1, handlers)
+        _run_rules_exec(workspace, few_path, False)  # Fill the cluster config and bytecode caches
+        for index in (False, True):
+            few = [_run_rules_exec(workspace, few_path, index) for _ in range(repeat)]
+            many = [_run_rules_exec(workspace, many_path, index) for _ in range(repeat)]
+            events_time = max(min(many) - min(few), 1e-9)
+            results.append({
+                'name': 'rules_exec',
+                'params': {'events': events, 'handlers': handlers, 'index': index},
+                'metrics': {'startup': _summary(few), 'total': _summary(many),
+                            'events_per_sec': events / events_time},
+            })
+    return results
+
+
+def bench_startup(tmp_dir, repeat: int):
+    results = []
+    with FakePowny() as powny:
+        workspace = _Workspace(tmp_dir, powny.url)
+        for args in (['--version'], workspace.get_args('job', 'list')):
+            _run_process(workspace, *args)
+            samples = [_run_process(workspace, *args) for _ in range(repeat)]
+            results.append({'name': 'startup', 'params': {'command': args[-1]}, 'metrics': _summary(samples)})
+    return results
+
+
+SCENARIOS = ('send_event', 'job_list', 'rules_exec', 'job_logs', 'startup')
+
+
+@click.command()
+@click.option('--output', '-o', type=click.File('w'), default='-', help="File for JSON results")
+@click.option('--scenario', '-s', 'scenarios', type=click.Choice(SCENARIOS), multiple=True,
+              help="Run only these scenarios")
+@click.option('--repeat', '-r', type=click.IntRange(1), default=5, help="Measurements per scenario")
+@click.option('--events', type=click.IntRange(1), default=2000, help="Events for `send-event` and `rules exec`")
+@click.option('--concurrency', type=click.IntRange(1), multiple=True, default=(1, 8),
+              help="Concurrency levels of `send-event`")
+@click.option('--jobs', type=click.IntRange(0), default=10000, help="Size of the jobs table for `job list`")
+@click.option('--handlers', type=click.IntRange(1), default=100, help="Handlers in the rules for `rules exec`")
+@click.option('--hits', type=click.IntRange(0), default=5000, help="Log records for `job logs`")
+def main(output, scenarios, repeat, events, concurrency, jobs, handlers, hits):
+    """
+    Measure powny-cli hot paths against a local fake Powny API and print JSON results.
+    """
+    started = datetime.utcnow()
+    tmp_dir = tempfile.mkdtemp(prefix='powny-bench-')
+    # Isolate user config and caches, `~` is expanded when they are used
+    os.environ['HOME'] = tmp_dir
+
+    results = []
+    try:
+        for name in scenarios or SCENARIOS:
+            scenario_dir = os.path.join(tmp_dir, name)
+            os.makedirs(scenario_dir)
+            click.echo("Running {}...".format(name), err=True)
+            if name == 'send_event':
+                results.extend(bench_send_event(scenario_dir, repeat, events, concurrency))
+            elif name == 'job_list':
+                results.extend(bench_job_list(scenario_dir, repeat, jobs))
+            elif name == 'rules_exec':
+                results.extend(bench_rules_exec(scenario_dir, repeat, events, handlers))
+            elif name == 'job_logs':
+                results.extend(bench_job_logs(scenario_dir, repeat, hits))
+            elif name == 'startup':
+                results.extend(bench_startup(scenario_dir, repeat))
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    json.dump({
+        'version': pownycli.__version__,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'started': started.strftime('%Y-%m-%dT%H:%M:%SZ'),
+        'repeat': repeat,
+        'results': results,
+    }, output, indent=4, sort_keys=True)
+    output.write('\n')
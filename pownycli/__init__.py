@@ -1,3 +1 @@
-import pkg_resources
-
-__version__ = pkg_resources.get_distribution('powny-cli').version
+__version__ = '0.9.3'
@@ -0,0 +1,113 @@
+"""
+This module is a small on-disk cache for data fetched from Powny.
+Every entry is a JSON file in `~/.config/powny-cli/cache/` named by its kind and a hash of its key.
+"""
+
+import os
+import json
+import time
+import hashlib
+import logging
+from pownycli import pownyapi
+
+logger = logging.getLogger(__name__)
+
+CACHE_DIR = '~/.config/powny-cli/cache'
+CLUSTER_CONFIG = 'cluster-config'
+
+
+class CacheError(Exception):
+    pass
+
+
+def get_cache_dir():
+    return os.path.expanduser(CACHE_DIR)
+
+
+def _entry_path(kind: str, key: str):
+    digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+    return os.path.join(get_cache_dir(), '{}-{}.json'.format(kind, digest))
+
+
+def load(kind: str, key: str):
+    path = _entry_path(kind, key)
+    try:
+        with open(path) as entry_file:
+            entry = json.load(entry_file)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as error:
+        logger.warning("Can't read cache entry %s: %s", path, error)
+        return None
+    if entry.get('key') != key:
+        return None
+    return entry
+
+
+def store(kind: str, key: str, value, **meta):
+    os.makedirs(get_cache_dir(), exist_ok=True)
+    path = _entry_path(kind, key)
+    entry = dict(meta, kind=kind, key=key, fetched=time.time(), value=value)
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'w') as entry_file:
+        json.dump(entry, entry_file)
+    os.replace(tmp_path, path)
+    return entry
+
+
+def iter_entries():
+    """Yield `(path, entry)` for all cache entries, entry values are not loaded into the result"""
+    cache_dir = get_cache_dir()
+    if not os.path.isdir(cache_dir):
+        return
+    for name in sorted(os.listdir(cache_dir)):
+        if not name.endswith('.json'):
+            continue
+        path = os.path.join(cache_dir, name)
+        try:
+            with open(path) as entry_file:
+                entry = json.load(entry_file)
+        except (OSError, ValueError) as error:
+            logger.warning("Can't read cache entry %s: %s", path, error)
+            continue
+        entry.pop('value', None)
+        yield path, entry
+
+
+def purge(kind=None):
+    removed = 0
+    for (path, entry) in list(iter_entries()):
+        if kind is None or entry.get('kind') == kind:
+            os.remove(path)
+            removed += 1
+    return removed
+
+
+def get_cluster_config(powny_server: str, ttl: int, offline=False):
+    """
+    Return cluster config for `powny_server` from the cache if it is younger than `ttl` seconds.
+    Otherwise revalidate it with ETag/If-Modified-Since; if the API is unavailable, fall back to the cached copy.
+    """
+    entry = load(CLUSTER_CONFIG, powny_server)
+    if entry is not None and (offline or time.time() - entry['fetched'] < ttl):
+        logger.debug("Use cached cluster config of %s", powny_server)
+        return entry['value']
+    if offline:
+        raise CacheError("Cluster config of {} is not cached. Run without `--offline` to fetch it.".format(
+            powny_server))
+
+    etag = entry and entry.get('etag')
+    last_modified = entry and entry.get('last_modified')
+    try:
+        config, etag, last_modified = pownyapi.revalidate_cluster_config(powny_server, etag, last_modified)
+    except pownyapi.PownyAPIException as error:
+        if entry is None:
+            raise
+        logger.warning("Can't revalidate cluster config (%s). Use the cached one.", error)
+        return entry['value']
+
+    if config is None:
+        logger.debug("Cached cluster config of %s is not modified", powny_server)
+        config = entry['value']
+    store(CLUSTER_CONFIG, powny_server, config, etag=etag, last_modified=last_modified)
+    return config
@@ -0,0 +1,237 @@
+"""
+This module is CAS storages for local rules execution.
+
+Every storage keeps the semantics of Powny's `CasStorage.replace_value()`:
+the new value is written only if its version is greater than the stored one.
+Stored times are kept as unix time and are converted to ISO format only in snapshots.
+Snapshots are JSON files `{path: {"value": ..., "version": ..., "stored": "<ISO time>"}}`,
+the same records Powny keeps in its CAS storage.
+"""
+
+import os
+import json
+import time
+import sqlite3
+import logging
+import threading
+import contextlib
+import multiprocessing
+from powny.core import tools
+from powny.core.backends import CasNoValue, CasNoValueError, CasData, CasVersionError
+
+logger = logging.getLogger(__name__)
+
+
+class BaseCas:
+    def _lock(self):
+        raise NotImplementedError
+
+    def _get(self, path):
+        """Returns `(value, version, stored)` or None"""
+        raise NotImplementedError
+
+    def _set(self, path, value, version, stored):
+        raise NotImplementedError
+
+    def items(self):
+        """Yields `(path, (value, version, stored))`"""
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+    def set_value(self, path, value, version=None):
+        try:
+            self.replace_value(path, value=value, version=version, default=None)
+            return True
+        except CasVersionError:
+            logger.exception("Can't set '%s' value with version %s", path, version)
+            return False
+
+    def get_value(self, path, default=CasNoValue):
+        return self.replace_value(path, value=CasNoValue, default=default)[0]
+
+    def replace_value(self, path, value=CasNoValue, version=None, default=CasNoValue, fatal_write=True):
+        with self._lock():
+            old = self._get(path)
+            if old is None:
+                if default is CasNoValue:
+                    raise CasNoValueError()
+                old = CasData(value=default, version=None, stored=None)
+            else:
+                old = CasData(*old)
+            if value is not CasNoValue:
+                if version is not None and old.version is not None and version <= old.version:
+                    write_ok = False
+                    msg = "Can't rewrite '{}' with version {} (old version: {})".format(path, version, old.version)
+                    if fatal_write:
+                        raise CasVersionError(msg)
+                    else:
+                        logger.debug(msg)
+                else:
+                    self._set(path, value, version, time.time())
+                    write_ok = True
+            else:
+                write_ok = None
+        return old, write_ok
+
+    def dump(self):
+        """Returns snapshot of the storage"""
+        return {
+            path: {"value": value, "version": version, "stored": tools.make_isotime(stored)}
+            for (path, (value, version, stored)) in self.items()
+        }
+
+    def load(self, snapshot: dict):
+        """Writes records of the snapshot over the current ones"""
+        with self._lock():
+            for (path, record) in snapshot.items():
+                stored = record.get("stored")
+                self._set(path, record["value"], record.get("version"),
+                          tools.from_isotime(stored) if stored else time.time())
+        logger.debug("Loaded %d CAS records", len(snapshot))
+
+
+class MemoryCas(BaseCas):
+    """Storage in a dict of the current process"""
+
+    def __init__(self):
+        self._data = {}
+        self._mutex = threading.RLock()
+
+    def __getstate__(self):
+        return {'_data': self._data}
+
+    def __setstate__(self, state):
+        self._data = state['_data']
+        self._mutex = threading.RLock()
+
+    def _lock(self):
+        return self._mutex
+
+    def _get(self, path):
+        return self._data.get(path)
+
+    def _set(self, path, value, version, stored):
+        self._data[path] = (value, version, stored)
+
+    def items(self):
+        return list(self._data.items())
+
+    def clear(self):
+        self._data.clear()
+
+
+class SqliteCas(BaseCas):
+    """
+    Persistent storage in a SQLite database.
+    It could be used by several processes at once and keeps the state between runs.
+    """
+
+    def __init__(self, path: str):
+        self.path = os.path.abspath(os.path.expanduser(path))
+        self._connection = None
+        self._pid = None
+        self._mutex = threading.RLock()
+        with self._lock():
+            self._get_connection().execute(
+                "CREATE TABLE IF NOT EXISTS cas (path TEXT PRIMARY KEY, value TEXT, version, stored REAL)")
+
+    def __getstate__(self):
+        return {'path': self.path}
+
+    def __setstate__(self, state):
+        self.path = state['path']
+        self._connection = None
+        self._pid = None
+        self._mutex = threading.RLock()
+
+    def _get_connection(self):
+        if self._connection is None or self._pid != os.getpid():
+            self._connection = sqlite3.connect(self.path, timeout=60, isolation_level=None,
+                                               check_same_thread=False)
+            self._pid = os.getpid()
+        return self._connection
+
+    @contextlib.contextmanager
+    def _lock(self):
+        with self._mutex:
+            connection = self._get_connection()
+            if connection.in_transaction:  # Nested call from load()
+                yield
+                return
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                yield
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+            else:
+                connection.execute("COMMIT")
+
+    def _get(self, path):
+        row = self._get_connection().execute(
+            "SELECT value, version, stored FROM cas WHERE path = ?", (path,)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0]), row[1], row[2]
+
+    def _set(self, path, value, version, stored):
+        self._get_connection().execute("INSERT OR REPLACE INTO cas VALUES (?, ?, ?, ?)",
+                                       (path, json.dumps(value), version, stored))
+
+    def items(self):
+        rows = self._get_connection().execute("SELECT path, value, version, stored FROM cas ORDER BY path")
+        return [(path, (json.loads(value), version, stored)) for (path, value, version, stored) in rows]
+
+    def clear(self):
+        with self._lock():
+            self._get_connection().execute("DELETE FROM cas")
+
+
+class SharedCas(BaseCas):
+    """
+    Storage shared by the current process and its worker processes through a multiprocessing manager.
+    The state is lost when the parent process exits.
+    """
+
+    def __init__(self):
+        self._manager = multiprocessing.Manager()
+        self._data = self._manager.dict()
+        self._mutex = self._manager.RLock()
+
+    def __getstate__(self):
+        # Proxies are reconnected to the manager of the parent process after unpickling
+        return {'_data': self._data, '_mutex': self._mutex}
+
+    def _lock(self):
+        return self._mutex
+
+    def _get(self, path):
+        return self._data.get(path)
+
+    def _set(self, path, value, version, stored):
+        self._data[path] = (value, version, stored)
+
+    def items(self):
+        return sorted(self._data.items())
+
+    def clear(self):
+        self._data.clear()
+
+
+def make_storage(spec: str):
+    """
+    Create storage by a spec:
+        memory -- in the current process (default)
+        shared -- shared by worker processes
+        sqlite:<path> -- persistent SQLite database
+    """
+    kind, _, path = spec.partition(':')
+    if kind == 'memory':
+        return MemoryCas()
+    elif kind == 'shared':
+        return SharedCas()
+    elif kind == 'sqlite' and path:
+        return SqliteCas(path)
+    raise ValueError("Unknown CAS storage `{}`. Use `memory`, `shared` or `sqlite:<path>`.".format(spec))
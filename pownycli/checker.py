@@ -1,8 +1,21 @@
+import os
+import sys
+import time
 import logging
-from pownycli import pownyapi
+import importlib
+import traceback
+import contextlib
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from itertools import islice
+from pownycli import cas
+from pownycli import cache
+from pownycli import rulecache
+from pownycli import watcher
 from pownycli.settings import Settings
-from powny.core import context, apps, tools, rules
-from powny.core.backends import CasNoValue, CasNoValueError, CasData, CasVersionError
+from pownycli.matchindex import HandlerIndex
+from pownycli.util import bounded_map
+from powny.core import context, apps, tools, rules, imprules
 
 logger = logging.getLogger(__name__)
 
@@ -11,44 +24,9 @@ class PownyCheckerException(Exception):
     pass
 
 
-class FakeCas:
-    data = {}
-
-    @classmethod
-    def replace_value(cls, path, value=CasNoValue, version=None,
-                      default=CasNoValue, fatal_write=True):
-        old = cls.data.get(path)
-        if old is None:
-            if default is CasNoValue:
-                raise CasNoValueError()
-            old = CasData(value=default, version=None, stored=None)
-        else:
-            old = CasData(
-                value=old["value"],
-                version=old["version"],
-                stored=tools.from_isotime(old["stored"]),
-            )
-        if value is not CasNoValue:
-            if version is not None and old.version is not None and version <= old.version:
-                write_ok = False
-                msg = "Can't rewrite '{}' with version {} (old version: {})".format(path, version, old.version)
-                if fatal_write:
-                    raise CasVersionError(msg)
-                else:
-                    logger.debug(msg)
-            else:
-                cls.data[path] = {
-                    "value": value,
-                    "version": version,
-                    "stored": tools.make_isotime(),
-                }
-                write_ok = True
-        else:
-            write_ok = None
-        return old, write_ok
-
-
 class FakeContext:
+    cas_storage = cas.MemoryCas()
+
     def __init__(self):
         self.number = 0
         self.old_value = None
@@ -63,9 +41,9 @@ class FakeContext:
     def save(self):
         pass
 
-    @staticmethod
-    def get_cas_storage():
-        return FakeCas
+    @classmethod
+    def get_cas_storage(cls):
+        return cls.cas_storage
 
 
 def _build_events(events_desc):
@@ -76,26 +54,342 @@ def _build_events(events_desc):
         yield event
 
 
-def _get_cluster_config(powny_server: str):
-    config = pownyapi.get_cluster_config(powny_server)
+def _get_cluster_config(powny_server: str, ttl: int, offline: bool):
+    config = cache.get_cluster_config(powny_server, ttl, offline)
     return config
 
 
-def check(config, events_desc):
-    cluster_config = Settings.merge(config, _get_cluster_config(config.get('powny_api_url')))
-    apps.init('powny', 'local', args=None, raw_config=cluster_config)
+def _load_rules(config):
+    apps.init('powny', 'local', args=None, raw_config=config)
 
     context.get_context = FakeContext
 
-    exposed, errors = tools.make_loader(config.get('rules-path')).get_exposed(config['rules-path'])
+    loader = tools.make_loader(config.get('rules-path'))
+    if (config.get('cache') or {}).get('rules_bytecode', True):
+        with rulecache.bytecode_cache(config['rules-path']):
+            return loader.get_exposed(config['rules-path'])
+    return loader.get_exposed(config['rules-path'])
+
+
+_loaded_rules = None
+
+
+def load_rules(config):
+    """
+    Load the rules once per process and return `(exposed, errors)`.
+    Powny can't be initialized twice, so later calls (e.g. from `powny shell`) only re-import the modules
+    changed since the previous one, like `watch()` does. The cluster config of the first call is kept.
+    """
+    global _loaded_rules
+    rules_path = config['rules-path']
+    if _loaded_rules is None:
+        snapshot = watcher.snapshot(rules_path)
+        exposed, errors = _load_rules(config)
+        _loaded_rules = (rules_path, snapshot, exposed, dict(errors))
+        return exposed, _loaded_rules[3]
+
+    loaded_path, snapshot, exposed, errors = _loaded_rules
+    if loaded_path != rules_path:
+        raise PownyCheckerException("Rules from {} are already loaded, rules from {} can't be loaded "
+                                    "in the same process".format(loaded_path, rules_path))
+    current = watcher.snapshot(rules_path)
+    changed = watcher.get_changed(snapshot, current)
+    if changed:
+        started = time.time()
+        _reload_modules(rules_path, changed, errors)
+        exposed = _collect_exposed(rules_path)
+        logger.info("%d changed rule modules reloaded in %.3f sec", len(changed), time.time() - started)
+    _loaded_rules = (rules_path, current, exposed, errors)
+    return exposed, errors
+
+
+def preload(config, offline=False):
+    """Load the rules in advance, so the first execution in a long-lived process doesn't wait for them"""
+    exposed, errors = load_rules(_merge_cluster_config(config, offline))
+    _report_load_errors(errors)
+    return exposed
+
 
+def make_executor(config, use_index=False, offline=False):
+    """
+    Load the rules and return a function executing one event by them, e.g. to execute events as they come.
+    It reports the results and raises `PownyCheckerException` if any handler fails.
+    """
+    exposed = preload(config, offline)
+    index = _make_index(exposed, use_index, False)
+
+    def execute(event):
+        event = next(_build_events([event]))
+        results = _execute(exposed, event, index)
+        _report_results(event, results)
+        failed = [name for (name, error) in results if error is not None]
+        if failed:
+            raise PownyCheckerException("Handlers failed: {}".format(', '.join(failed)))
+        return results
+    return execute
+
+
+def _report_load_errors(errors):
     for module in errors:
         logger.error("Can't load %s module by reason %s", module, errors[module])
 
+
+def _make_index(exposed, use_index: bool, verify_index: bool):
+    if use_index or verify_index:
+        return HandlerIndex(exposed.get("handlers", {}), rules.check_match, verify=verify_index)
+    return None
+
+
+def _execute(exposed, event, index=None):
+    """
+    Run all handlers matched with the event.
+    Returns list of `(handler name, error)` pairs, error is `None` for successful executions.
+    """
+    handlers = exposed.get("handlers", {})
+    if index is None:
+        matched = [name for (name, handler) in handlers.items() if rules.check_match(handler, event)]
+    else:
+        matched = index.match(event)
+
+    results = []
+    for name in matched:
+        try:
+            handlers[name](**event)
+        except Exception:
+            results.append((name, traceback.format_exc()))
+        else:
+            results.append((name, None))
+    return results
+
+
+def _report_results(event, results):
+    for (name, error) in results:
+        if error is None:
+            logger.debug("Event %s executed by %s rule", event, name)
+        else:
+            logger.error("Can't execute %s rule by reason %s", name, error)
+
+
+_worker_config = None
+_worker_rules = None
+
+
+def _init_worker(config, use_index, verify_index, cas_storage):
+    """Process pool initializer: the config and CAS storage are passed to each worker once, not with every chunk"""
+    global _worker_config
+    FakeContext.cas_storage = cas_storage
+    _worker_config = (config, use_index, verify_index)
+
+
+def _check_chunk(events):
+    """
+    Process pool task: execute a chunk of events.
+    The rules are loaded once per worker process, on the first chunk; load errors are returned only then.
+    """
+    global _worker_rules
+    errors = None
+    if _worker_rules is None:
+        config, use_index, verify_index = _worker_config
+        exposed, errors = load_rules(config)
+        _worker_rules = (exposed, _make_index(exposed, use_index, verify_index))
+    exposed, index = _worker_rules
+    return errors, [_execute(exposed, event, index) for event in events]
+
+
+def _iter_chunks(items, size):
+    items = iter(items)
+    while True:
+        chunk = list(islice(items, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _check_parallel(config, events, workers: int, chunk_size: int, use_index: bool, verify_index: bool):
+    reported = False
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(config, use_index, verify_index, FakeContext.cas_storage)) as executor:
+        for (chunk, future) in bounded_map(executor, _check_chunk, _iter_chunks(events, chunk_size), workers * 2):
+            errors, chunk_results = future.result()
+            if errors is not None and not reported:
+                _report_load_errors(errors)
+                reported = True
+            for (event, results) in zip(chunk, chunk_results):
+                _report_results(event, results)
+
+
+def _merge_cluster_config(config, offline: bool):
+    ttl = (config.get('cache') or {}).get('cluster_config_ttl', 3600)
+    return Settings.merge(config, _get_cluster_config(config.get('powny_api_url'), ttl, offline))
+
+
+def _prepare_cas(cas_storage, cas_snapshot):
+    if cas_storage is not None:
+        FakeContext.cas_storage = cas_storage
+    if cas_snapshot:
+        FakeContext.cas_storage.load(cas_snapshot)
+
+
+def check(config, events_desc, workers=1, chunk_size=100, use_index=False, verify_index=False, offline=False,
+          cas_storage=None, cas_snapshot=None):
+    """
+    Execute events by the local rules.
+    With `workers > 1` events are sharded across a process pool, results are reported in the input order.
+    With the default in-memory CAS storage every worker has its own copy of CAS state, so rules depending
+    on it should be checked with one worker or with a shared storage (see `cas.make_storage`).
+    `cas_snapshot` is written into the storage before the events.
+    With `use_index` handlers are matched through `HandlerIndex`, `verify_index` checks it against the full scan.
+    The cluster config is taken from the cache, `offline` forbids to fetch it from the API.
+    """
+    cluster_config = _merge_cluster_config(config, offline)
+    _prepare_cas(cas_storage, cas_snapshot)
+
+    if workers > 1:
+        _check_parallel(cluster_config, _build_events(events_desc), workers, chunk_size, use_index, verify_index)
+        return
+
+    exposed, errors = load_rules(cluster_config)
+    _report_load_errors(errors)
+    index = _make_index(exposed, use_index, verify_index)
+
     for event in _build_events(events_desc):
-        for (name, handler) in exposed.get("handlers", {}).items():
-            if rules.check_match(handler, event):
-                try:
-                    handler(**event)
-                except Exception as error:
-                    logger.exception("Can't execute %s rule by reason %s", name, error)
+        _report_results(event, _execute(exposed, event, index))
+
+
+_preflight_stack = None
+
+
+def _preflight_module(config, name: str):
+    """
+    Process pool task: import one rule module, return `(seconds, traceback or None)`.
+    The worker is prepared like `_load_rules()` does it, on the first task. A worker forked from a process
+    with loaded rules (`powny shell`) is already initialized and re-executes the inherited modules.
+    """
+    global _preflight_stack
+    if _preflight_stack is None:
+        if _loaded_rules is None:
+            apps.init('powny', 'local', args=None, raw_config=config)
+            context.get_context = FakeContext
+        _preflight_stack = contextlib.ExitStack()
+        if (config.get('cache') or {}).get('rules_bytecode', True):
+            _preflight_stack.enter_context(rulecache.bytecode_cache(config['rules-path']))
+        sys.path.insert(0, config['rules-path'])
+    started = time.time()
+    try:
+        if name in sys.modules and _loaded_rules is not None:
+            importlib.reload(sys.modules[name])
+        else:
+            importlib.import_module(name)
+    except Exception:
+        return time.time() - started, traceback.format_exc()
+    return time.time() - started, None
+
+
+def preflight(config, workers=None, offline=False, slowest=5):
+    """
+    Import every rule module as `tools.make_loader(...).get_exposed()` does, but in a process pool,
+    and report the import time of the `slowest` modules. Raise `PownyCheckerException` if any of them fails.
+    A module imported by an earlier one in the same worker is counted as loaded instantly.
+    """
+    cluster_config = _merge_cluster_config(config, offline)
+    names = imprules._get_all_modules(config['rules-path'])  # pylint: disable=protected-access
+    if not names:
+        return {}
+    workers = min(workers or os.cpu_count() or 1, len(names))
+
+    started = time.time()
+    times, errors = {}, {}
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        task = partial(_preflight_module, cluster_config)
+        for (name, future) in bounded_map(executor, task, names, workers * 2):
+            times[name], error = future.result()
+            if error is not None:
+                errors[name] = error
+    logger.info("Loaded %d rule modules in %.2f sec", len(names), time.time() - started)
+    for name in sorted(times, key=times.get, reverse=True)[:slowest]:
+        logger.info(" --- %.3f sec %s", times[name], name)
+
+    if errors:
+        _report_load_errors(errors)
+        raise PownyCheckerException("{} of {} rule modules can't be loaded".format(len(errors), len(names)))
+    return times
+
+
+def _get_module_name(rules_path: str, file_path: str):
+    name = os.path.splitext(os.path.relpath(file_path, rules_path))[0].replace(os.sep, '.')
+    if name.endswith('.__init__'):
+        name = name[:-len('.__init__')]
+    return name
+
+
+def _reload_modules(rules_path: str, files, errors: dict):
+    """Re-import only the modules of the changed files, `errors` is updated in place"""
+    sys.path.insert(0, rules_path)
+    try:
+        for file_path in sorted(files):
+            name = _get_module_name(rules_path, file_path)
+            errors.pop(name, None)
+            if not os.path.exists(file_path):
+                sys.modules.pop(name, None)
+                logger.info("Module %s removed", name)
+                continue
+            try:
+                if name in sys.modules:
+                    importlib.reload(sys.modules[name])
+                else:
+                    importlib.import_module(name)
+            except Exception:
+                errors[name] = traceback.format_exc()
+            else:
+                logger.info("Module %s reloaded", name)
+    finally:
+        sys.path.remove(rules_path)
+
+
+def _collect_exposed(rules_path: str):
+    """Group exposed methods of the loaded rule modules the same way as `tools.make_loader` does"""
+    root = os.path.abspath(rules_path) + os.sep
+    exposed = {"handlers": {}, "methods": {}}
+    for (module_name, module) in list(sys.modules.items()):
+        if not (getattr(module, '__file__', None) or '').startswith(root):
+            continue
+        for obj_name in dir(module):
+            if obj_name.startswith("__"):
+                continue
+            obj = getattr(module, obj_name)
+            if callable(obj) and getattr(obj, imprules._ATTR_EXPOSED, False):  # pylint: disable=protected-access
+                group = "handlers" if rules.is_event_handler(obj) else "methods"
+                exposed[group]["{}.{}".format(module_name, obj_name)] = obj
+    return exposed
+
+
+def watch(config, events_desc, interval=0.5, use_index=False, verify_index=False, offline=False,
+          cas_storage=None, cas_snapshot=None):
+    """
+    Execute events by the local rules and execute them again after every change in the rules directory.
+    Only the modules of changed files are re-imported, so modules which import names from them
+    keep the old objects until they are saved too.
+    `cas_snapshot` is loaded once. In-memory CAS storage is reset to it before each rerun,
+    shared and persistent ones keep the state of the previous runs.
+    """
+    events = list(_build_events(events_desc))
+    rules_path = config['rules-path']
+    exposed, errors = load_rules(_merge_cluster_config(config, offline))
+    changes = watcher.iter_changes(rules_path, interval)
+    _prepare_cas(cas_storage, cas_snapshot)
+
+    while True:
+        _report_load_errors(errors)
+        index = _make_index(exposed, use_index, verify_index)
+        for event in events:
+            _report_results(event, _execute(exposed, event, index))
+
+        logger.info("Waiting for changes in %s...", rules_path)
+        changed = next(changes)
+        started = time.time()
+        _reload_modules(rules_path, changed, errors)
+        exposed = _collect_exposed(rules_path)
+        logger.info("Rules reloaded in %.3f sec", time.time() - started)
+        if isinstance(FakeContext.cas_storage, cas.MemoryCas):
+            FakeContext.cas_storage.clear()
+            _prepare_cas(None, cas_snapshot)
@@ -1,53 +1,70 @@
+"""
+Entry point of `powny`. Startup is kept cheap: modules of the commands (`requests`, Powny core, tables...)
+are imported by the commands themselves, so e.g. `powny --help` or `powny job list` don't pay for the others.
+"""
+
+import re
 import json
+import itertools
 import click
 import os
 import sys
 import logging
 import logging.config
-import requests
 import shutil
-import yaml
-import webbrowser
-import tabloid
-from pkg_resources import resource_stream
+import time
+from functools import partial
+from collections import OrderedDict
 from datetime import datetime as dt
+from pownycli import __version__
+from pownycli import gitrepo
+from pownycli.constants import PUSH_POLICIES
 from pownycli.settings import Settings
-from pownycli import gitapi
-from pownycli import pownyapi
-from pownycli import checker
-from requests.compat import urljoin
-from pownycli.util import Colorfull
 
 
 logger = logging.getLogger(__name__)
 
 
 def _validate_repo_path(ctx, param, value):
-    listing = os.listdir(value)
+    # The root of the current git repository by default, it is found without running git
+    return value or gitrepo.find_root(os.getcwd()) or '.'
+
+
+def _check_rules_repo():
+    """Only commands working with rules require the rules repository, the others just use its config if any"""
+    repo_path = Settings.get('rules-path')
+    listing = os.listdir(repo_path) if os.path.isdir(repo_path) else []
     if ('.git' not in listing) or ('pownyrules.yaml' not in listing):
         raise click.BadParameter(
             "{repo_path} is not git repository or file `pownyrules.yaml` not exist!"
-            " Make sure that the path is a Powny rules repository.".format(repo_path=value))
-    else:
-        return value
+            " Make sure that the path is a Powny rules repository.".format(repo_path=repo_path),
+            param_hint="'--work-dir'")
 
 
 def _validate_event_desc(ctx, param, event_file):
     if event_file is None:
         return None
+    from pownycli import events
+    return events.iter_events(event_file)
+
+
+def _validate_cas_spec(ctx, param, spec):
+    from pownycli import cas
     try:
-        events_desc = json.load(event_file)
-    except (TypeError, ValueError):
-        logger.error("Can't parse event description file %s", event_file)
-    else:
-        events = []
-        event_type = type(events_desc)
+        return cas.make_storage(spec)
+    except ValueError as error:
+        raise click.BadParameter(str(error))
 
-        if event_type is list:
-            events.extend(events_desc)
-        else:
-            events.append(events_desc)
-        return events
+
+def _validate_time(ctx, param, value):
+    if value is None:
+        return None
+    for time_format in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d', '%Y-%m-%dT%H:%M:%S'):
+        try:
+            return dt.strptime(value, time_format)
+        except ValueError:
+            continue
+    raise click.BadParameter("Time must be in `YYYY-MM-DD[ HH:MM[:SS]]` format, UTC")
 
 
 def _read_powny_api_url_from_settings(ctx, param, api_url):
@@ -77,13 +94,21 @@ def _get_event_from_args(event_args):
         raise click.BadParameter("You mast pass `host service status[:new status]` args or `--file` option")
 
 
+def _send_event(powny_server: str, event: dict):
+    from pownycli import pownyapi
+    if 'description' not in event:
+        event['description'] = ''
+    logger.info("Send event: {}".format(event))
+    return pownyapi.send_event(powny_server, event)
+
+
 @click.group()
 @click.option('--debug/--no-debug', '-d', help="Enable debug logs")
 @click.option('--work-dir', '-w', type=click.Path(), envvar='POWNY_WORK_DIR',
-              callback=_validate_repo_path, default=gitapi.get_root(fallback="."), help="Path to rules dir")
+              callback=_validate_repo_path, help="Path to rules dir, the current git repository by default")
 @click.option('--config', '-c', callback=Settings.load, type=click.File('r'),
               help="Load config from file", metavar='PATH')
-@click.version_option()
+@click.version_option(version=__version__)
 def cli(debug, work_dir, config):
     """
     Powny command line tool.
@@ -95,8 +120,12 @@ def cli(debug, work_dir, config):
 
     logging.config.dictConfig(Settings.get('logging', {}))
     # `pownyrules.yaml` from work dir has highest priority
-    with open(os.path.join(work_dir, 'pownyrules.yaml')) as repo_conf:
-        Settings.load(None, None, repo_conf)
+    repo_conf_path = os.path.join(work_dir, 'pownyrules.yaml')
+    if os.path.exists(repo_conf_path):
+        with open(repo_conf_path) as repo_conf:
+            Settings.load(None, None, repo_conf)
+    else:
+        logger.debug("%s not found, only user's config is used", repo_conf_path)
     Settings.config['rules-path'] = work_dir
 
 
@@ -117,7 +146,7 @@ def gen_config(force):
             raise RuntimeError(
                 "Config {}, already exist. Nothing generated. Use `--force` to rewrite it.".format(full_config_path))
 
-    with resource_stream(__name__, 'config.yaml') as source:
+    with open(Settings.get_default_config_path(), 'rb') as source:
         with open(full_config_path, 'wb') as target:
             shutil.copyfileobj(source, target)
     logging.info("%s file created", full_config_path)
@@ -129,6 +158,7 @@ def open_log_page(browser):
     """
     Open kibana logs dashboard in browser.
     """
+    import webbrowser
     url = Settings.get("kibana_dashboard_url")
     click.echo("Try to open {}".format(url))
 
@@ -141,12 +171,84 @@ def open_log_page(browser):
         logger.error("Can't open %s in %s browser. Error occurred: %s", url, browser or "default", error)
 
 
+def _get_value(structure, path):
+    for key in path:
+        structure = structure[key]
+    return structure
+
+
+def _echo_cluster_changes(changes, state: dict, depth: int):
+    """Print the sections (subtrees at `depth`) touched by the changes as they are now"""
+    import yaml
+    sections = OrderedDict.fromkeys(change.path[:depth] for change in changes)
+    click.echo("--- {} UTC, {} changes".format(dt.utcnow().strftime('%Y-%m-%d %H:%M:%S'), len(changes)))
+    for path in sections:
+        name = '.'.join(str(key) for key in path)
+        try:
+            value = _get_value(state, path)
+        except (KeyError, TypeError):
+            click.echo("{}: removed".format(name))
+            continue
+        click.echo(yaml.dump({name: value}, default_flow_style=False).rstrip())
+
+
+def _echo_cluster_deltas(changes):
+    now = dt.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')
+    for change in changes:
+        click.echo(json.dumps({'time': now, 'op': change.op, 'path': change.path, 'old': change.old,
+                               'new': change.new}, sort_keys=True))
+
+
+def _watch_cluster_info(powny_server: str, interval: float, json_lines: bool, ignore, depth: int):
+    """
+    Poll the cluster state through the shared keep-alive session and print only the differences.
+    The first state is printed whole, as a `snapshot` delta with `--json-lines`. Failed polls are skipped.
+    """
+    import yaml
+    from pownycli import pownyapi
+    from pownycli.util import Change, diff_structures
+    previous = pownyapi.get_cluster_info(powny_server)
+    if json_lines:
+        _echo_cluster_deltas([Change('snapshot', (), None, previous)])
+    else:
+        click.echo(yaml.dump(previous))
+    while True:
+        time.sleep(interval)
+        try:
+            state = pownyapi.get_cluster_info(powny_server)
+        except pownyapi.PownyAPIException as error:
+            logger.warning("Can't get cluster info, will retry: %s", error)
+            continue
+        changes = list(diff_structures(previous, state, ignore))
+        previous = state
+        if not changes:
+            continue
+        if json_lines:
+            _echo_cluster_deltas(changes)
+        else:
+            _echo_cluster_changes(changes, state, depth)
+
+
 @cli.command("cluster-info")
-def cluster_info():
+@click.option('--watch', is_flag=True, help="Poll the cluster state and show only its changes")
+@click.option('--interval', type=float, default=2.0, help="Polling interval for `--watch`, sec")
+@click.option('--json-lines', is_flag=True, help="Print changes as JSON lines (op, path, old and new values)")
+@click.option('--ignore', multiple=True, help="Don't watch keys with this name, e.g. `when`")
+@click.option('--depth', type=click.IntRange(1), default=2,
+              help="Depth of the sections printed when something inside them is changed")
+def cluster_info(watch, interval, json_lines, ignore, depth):
     """
     Show generic cluster info.
     """
-    powny_state = pownyapi.get_cluster_info(Settings.get('powny_api_url'))
+    import yaml
+    from pownycli import pownyapi
+    if json_lines and not watch:
+        raise click.BadParameter("`--json-lines` can be used only with `--watch`")
+    powny_server = Settings.get('powny_api_url')
+    if watch:
+        _watch_cluster_info(powny_server, interval, json_lines, ignore, depth)
+        return
+    powny_state = pownyapi.get_cluster_info(powny_server)
     click.echo(yaml.dump(powny_state))
 
 
@@ -157,28 +259,113 @@ def rules():
     """
 
 
+def _preflight_rules(workers):
+    from pownycli import checker
+    logger.info("Check that the rules can be loaded...")
+    checker.preflight(Settings.config, workers)
+
+
 @rules.command()
 @click.option('--force/--no-force', '-f', help="Force to upload rules")
-def upload(force):
+@click.option('--policy', type=click.Choice(PUSH_POLICIES),
+              help="Update HEAD if rules are pushed to all, the majority or any of Powny remotes")
+@click.option('--concurrency', '-n', type=click.IntRange(1), help="Pushes to Powny remotes running at once")
+@click.option('--push-timeout', type=float, help="Seconds to wait for a push to one Powny remote")
+@click.option('--preflight/--no-preflight', default=True,
+              help="Import the rules locally and don't upload them if some modules fail")
+def upload(force, policy, concurrency, push_timeout, preflight):
     """
     Upload new or changed rules in Powny.
     """
+    from pownycli import gitapi
+    _check_rules_repo()
+    options = Settings.config.get('rules_upload') or {}
+    check_rules = partial(_preflight_rules, options.get('preflight_workers')) if preflight else None
     logger.info("Upload updated rules to Powny...")
-    gitapi.upload(Settings.get('powny_api_url'), Settings.get('rules-path'), force)
+    gitapi.upload(Settings.get('powny_api_url'), Settings.get('rules-path'), force,
+                  policy=policy or options.get('policy', 'all'),
+                  concurrency=concurrency or options.get('concurrency', 4),
+                  timeout=push_timeout or options.get('push_timeout'),
+                  preflight=check_rules)
 
 
 @rules.command("exec")
 @click.argument('event_args', nargs=-1, required=False)
 @click.option('--event-desc', '-e', type=click.File('r'),
-              callback=_validate_event_desc, help="JSON file with event description")
-def execute(event_desc, event_args):
+              callback=_validate_event_desc, help="JSON or newline-delimited JSON file with events, `-` for stdin")
+@click.option('--workers', '-j', type=click.IntRange(1), default=1,
+              help="Amount of worker processes, each one loads the rules and executes a shard of events")
+@click.option('--index/--no-index', default=False,
+              help="Match events through the index of handlers' conditions instead of checking every handler")
+@click.option('--verify-index', is_flag=True, help="Check the index results against the full handlers scan")
+@click.option('--offline', is_flag=True, help="Use only the cached cluster config, don't request Powny API")
+@click.option('--watch', is_flag=True, help="Execute the events again on every change of the rules")
+@click.option('--interval', type=float, default=0.5, help="Polling interval for `--watch`, sec")
+@click.option('--cas', 'cas_spec', default='memory', callback=_validate_cas_spec,
+              help="CAS storage: `memory`, `shared` (between workers) or `sqlite:PATH` (persistent)")
+@click.option('--cas-load', type=click.File('r'), help="Load CAS state from JSON snapshot before the events")
+@click.option('--cas-dump', type=click.File('w'), help="Dump CAS state to JSON snapshot after the events")
+def execute(event_desc, event_args, workers, index, verify_index, offline, watch, interval,
+            cas_spec, cas_load, cas_dump):
     """
     Run Powny rules locally.
     """
+    from pownycli import cas, checker
+    if cas_dump and workers > 1 and isinstance(cas_spec, cas.MemoryCas):
+        # Every worker changes its own copy of the in-memory storage, the parent's one would be dumped
+        raise click.BadParameter("With `--workers` CAS state can be dumped only from `shared` or `sqlite:` storage",
+                                 param_hint="'--cas-dump'")
+    _check_rules_repo()
     events = event_desc or _get_event_from_args(event_args)
+    cas_snapshot = json.load(cas_load) if cas_load else None
 
     config = Settings.config
-    checker.check(config, events)
+    if watch:
+        checker.watch(config, events, interval=interval, use_index=index, verify_index=verify_index,
+                      offline=offline, cas_storage=cas_spec, cas_snapshot=cas_snapshot)
+    else:
+        checker.check(config, events, workers=workers, use_index=index, verify_index=verify_index,
+                      offline=offline, cas_storage=cas_spec, cas_snapshot=cas_snapshot)
+        if cas_dump:
+            json.dump(checker.FakeContext.cas_storage.dump(), cas_dump, indent=4, sort_keys=True)
+
+
+@cli.group("cache")
+def cache_group():
+    """
+    Inspect or purge local cache.
+    """
+
+
+@cache_group.command("show")
+def cache_show():
+    """
+    Show cached entries.
+    """
+    from pownycli import cache, rulecache
+    for (path, entry) in cache.iter_entries():
+        age = time.time() - entry.get('fetched', 0)
+        click.echo("{kind:15} {key} (age {age:.0f} sec, etag {etag}) {path}".format(
+            kind=entry.get('kind'), key=entry.get('key'), age=age, etag=entry.get('etag'), path=path))
+    bytecode = list(rulecache.iter_entries())
+    if bytecode:
+        click.echo("{:15} {} compiled rule modules in {}".format(
+            'bytecode', len(bytecode), rulecache.get_bytecode_dir()))
+
+
+@cache_group.command("purge")
+@click.option('--kind', '-k', help="Remove only entries of this kind, e.g. `cluster-config` or `bytecode`")
+def cache_purge(kind):
+    """
+    Remove cached entries.
+    """
+    from pownycli import cache, rulecache
+    removed = 0
+    if kind in (None, 'bytecode'):
+        removed += rulecache.purge()
+    if kind != 'bytecode':
+        removed += cache.purge(kind)
+    logger.info("%d cache entries removed", removed)
 
 
 @cli.group()
@@ -188,97 +375,540 @@ def job():
     """
 
 
-@job.command("logs")
-@click.option('--size', '-s', type=int, default=50, help="Amount of records")
-@click.argument('job_id', required=True)
-def job_logs(job_id, size):
-    elastic_url = Settings.get('elastic_url')
-    resp = requests.get(urljoin(elastic_url, '/_all/_search'),
-                        params={'q': 'job_id:%s' % job_id, 'size': size})
-    hits = resp.json()['hits']['hits']
-    hits.sort(key=lambda x: x["_source"]["@timestamp"])
-
-    lines = []
-    for hit in hits:
-        fields = hit["_source"]
-        message = fields["msg"]
-        args = fields.get("args")
-        time = dt.strptime(fields["@timestamp"], "%Y-%m-%dT%H:%M:%S.%f").strftime("%d %b %H:%M:%S")
-        level = fields["level"]
-        node = fields["node"]
-
-        if logger.getEffectiveLevel() != logging.DEBUG and level == 'DEBUG':
-            continue
+_LOG_TIMESTAMP = re.compile(r'\d{4}-(\d{2})-(\d{2})T(\d{2}:\d{2}:\d{2})\.\d+$')
+_MONTHS = [None] + [dt(2000, month, 1).strftime('%b') for month in range(1, 13)]
 
-        node_name, node_role = node.split('-')[0], node.split('-')[1]
 
-        if args:
-            try:
-                # To catch cases when `message = '%s (parents: %s)'`, but `args = ['Spawned the new job']`
-                formatted_msg = message % tuple(args)
-            except TypeError as error:
-                logger.warning("Can't format string. %s. So next record is a raw.", error)
-                formatted_msg = message + str(args)
-        else:
-            formatted_msg = message
+def _format_log_timestamp(timestamp: str):
+    """The same as `strptime(...).strftime("%d %b %H:%M:%S")`, but without parsing of the whole time"""
+    match = _LOG_TIMESTAMP.match(timestamp)
+    if match is None or not 1 <= int(match.group(1)) <= 12:
+        return dt.strptime(timestamp, "%Y-%m-%dT%H:%M:%S.%f").strftime("%d %b %H:%M:%S")
+    month, day, clock = match.groups()
+    return '{} {} {}'.format(day, _MONTHS[int(month)], clock)
 
-        lines.append([node_name, node_role, time, level, formatted_msg])
 
-    table = tabloid.FormattedTable()
+def _format_log_record(fields: dict, show_debug: bool):
+    """Returns row of the logs table or None if the record is filtered out"""
+    level = fields["level"]
+    if level == 'DEBUG' and not show_debug:
+        return None
+
+    message = fields["msg"]
+    args = fields.get("args")
+    node_name, node_role = fields["node"].split('-', 2)[:2]
+
+    if args:
+        try:
+            # To catch cases when `message = '%s (parents: %s)'`, but `args = ['Spawned the new job']`
+            formatted_msg = message % tuple(args)
+        except TypeError as error:
+            logger.warning("Can't format string. %s. So next record is a raw.", error)
+            formatted_msg = message + str(args)
+    else:
+        formatted_msg = message
+
+    return [node_name, node_role, _format_log_timestamp(fields["@timestamp"]), level, formatted_msg]
+
+
+def _get_job_created(powny_server: str, job_id: str):
+    """Creation time of the job from Powny API, None if it is unknown"""
+    from pownycli import pownyapi
+    try:
+        job_info = pownyapi.get_job_info(powny_server, job_id)
+    except pownyapi.PownyAPIException as error:
+        logger.warning("Can't get job %s info: %s", job_id, error)
+        return None
+    if job_info is None:
+        logger.info("Job %s is not found in Powny, its logs will be searched in all indices", job_id)
+        return None
+    return dt.strptime(job_info['created'], "%Y-%m-%d %H:%M:%S.%fZ")
+
+
+def _get_jobs_created(job_ids):
+    """Creation time of the earliest job, None if it is unknown for any of them"""
+    from concurrent.futures import ThreadPoolExecutor
+    from pownycli import pownyapi
+    from pownycli.util import bounded_map
+    powny_server = Settings.get('powny_api_url')
+    concurrency = min(len(job_ids), pownyapi.PownySession.get_option('pool_size'))
+    created = []
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for (_, future) in bounded_map(executor, partial(_get_job_created, powny_server), job_ids, concurrency):
+            created.append(future.result())
+    return None if None in created else min(created)
+
+
+def _read_job_ids(ctx, param, output):
+    """Job ids from `job send-event` output: the first word of each line"""
+    if output is None:
+        return []
+    return [line.split()[0] for line in output if line.strip()]
+
+
+def _make_logs_table(with_job: bool):
+    from pownycli.util import Colorfull, StreamingTable
+    table = StreamingTable()
+    if with_job:
+        table.add_column('Job', width=8)
     table.add_column('Role')
     table.add_column('Node', Colorfull.get_node)
-    table.add_column('Time', Colorfull.timestamp)
-    table.add_column('Level', Colorfull.get_level)
+    table.add_column('Time', Colorfull.timestamp, width=len('01 Jan 00:00:00'))
+    table.add_column('Level', Colorfull.get_level, width=len('CRITICAL'))
     table.add_column('Message')
+    return table
 
-    for line in lines:
-        table.add_row(line)
 
-    formatted_out = '\n'.join(table.get_table())
+@job.command("logs")
+@click.option('--size', '-s', type=click.IntRange(0), default=0,
+              help="Amount of records, 0 for all of them. With `--follow` the last ones are shown before new ones.")
+@click.option('--page-size', type=click.IntRange(1), default=500, help="Records fetched per request")
+@click.option('--follow', '-f', is_flag=True, help="Wait for new records and print them as they appear")
+@click.option('--interval', type=float, default=1.0,
+              help="Polling interval for `--follow`, sec. It grows while there are no new records.")
+@click.option('--max-interval', type=float, default=10.0, help="Maximum polling interval, sec")
+@click.option('--since', callback=_validate_time, help="Show records since this time, UTC")
+@click.option('--until', callback=_validate_time, help="Show records until this time, UTC")
+@click.option('--from-event', type=click.File('r'), callback=_read_job_ids,
+              help="Take job ids from `job send-event` output, `-` for stdin")
+@click.option('--group', is_flag=True, help="Show records of several jobs job by job instead of interleaving them")
+@click.argument('job_ids', nargs=-1)
+def job_logs(job_ids, size, page_size, follow, interval, max_interval, since, until, from_event, group):
+    """
+    Show logs of one or several jobs sorted by time.
+    Records of all jobs are fetched by one query, page by page, so the output starts before all of them are received.
+    With `--follow` new records are polled by the last seen timestamp and appended to the output.
+    If `elastic_index_pattern` is set, only the indices since the job creation (or `--since`) are searched.
+    """
+    from pownycli import elasticapi
+    job_ids = list(OrderedDict.fromkeys(job_ids + tuple(from_event)))
+    if not job_ids:
+        raise click.BadParameter("Pass job ids as arguments or with `--from-event`")
+    if follow and until:
+        raise click.BadParameter("`--until` can't be used with `--follow`")
+    if follow and group:
+        raise click.BadParameter("`--group` can't be used with `--follow`")
+
+    index_pattern = Settings.config.get('elastic_index_pattern')
+    index_since = _get_jobs_created(job_ids) if index_pattern and since is None else None
+    query = elasticapi.JobLogsQuery(job_ids, since, until, index_pattern, index_since,
+                                    Settings.config.get('elastic_job_id_field') or 'job_id.raw', group)
 
-    if formatted_out:
-        click.echo(formatted_out)
+    elastic_url = Settings.get('elastic_url')
+    if follow:
+        pages = elasticapi.follow_job_logs(elastic_url, query, size, page_size, interval, max_interval)
     else:
+        pages = elasticapi.iter_job_logs(elastic_url, query, size, page_size)
+
+    show_debug = logger.getEffectiveLevel() == logging.DEBUG
+    with_job = len(job_ids) > 1 and not group
+    table = _make_logs_table(with_job)
+    current_job = title = None
+    printed = False
+    for hits in pages:
+        lines = []
+        for (job_id, job_hits) in itertools.groupby(hits, key=query.get_job_id):
+            if group and job_id != current_job:
+                # Every job has its own table
+                current_job = job_id
+                table = _make_logs_table(with_job)
+                title = "Job {}:".format(job_id)
+            rows = (_format_log_record(hit["_source"], show_debug) for hit in job_hits)
+            if with_job:
+                rows = (row and [(job_id or '')[:8]] + row for row in rows)
+            job_lines = list(table.iter_page(row for row in rows if row is not None))
+            if job_lines and title:
+                lines.append(title)
+                title = None
+            lines.extend(job_lines)
+        if lines:
+            click.echo('\n'.join(lines))
+            printed = True
+
+    if not printed:
         click.echo("No logs yet.")
 
 
+def _validate_duration(ctx, param, value):
+    if value is None:
+        return None
+    match = re.match(r'^(\d+(?:\.\d+)?)([smhd]?)$', value)
+    if match is None:
+        raise click.BadParameter("Duration must be like `90`, `90s`, `15m`, `2h` or `1d`")
+    return float(match.group(1)) * {'': 1, 's': 1, 'm': 60, 'h': 3600, 'd': 86400}[match.group(2)]
+
+
+JOB_STATES = ('new', 'taken', 'finished')
+
+
+def _get_job_state(job_info: dict):
+    if job_info.get('finished'):
+        return 'finished'
+    return 'taken' if job_info.get('taken') else 'new'
+
+
+def _match_job(job_info: dict, now, method=None, state=None, older_than=None, newer_than=None):
+    """Check the job info by the filters of `job list` and `job kill`, `*_than` are ages in seconds"""
+    from fnmatch import fnmatchcase
+    if method is not None and not fnmatchcase(job_info['method'], method):
+        return False
+    if state is not None and _get_job_state(job_info) != state:
+        return False
+    if older_than is not None or newer_than is not None:
+        age = (now - dt.strptime(job_info['created'], "%Y-%m-%d %H:%M:%S.%fZ")).total_seconds()
+        if (older_than is not None and age < older_than) or (newer_than is not None and age > newer_than):
+            return False
+    return True
+
+
+def _get_job_info(powny_server: str, job_id: str):
+    from pownycli import pownyapi
+    try:
+        return pownyapi.get_job_info(powny_server, job_id)
+    except pownyapi.PownyAPIException as error:
+        logger.error("Can't get job %s info, it is skipped: %s", job_id, error)
+        return None
+
+
+def _iter_job_infos(powny_server: str, job_ids, concurrency: int):
+    """
+    Yield `(job_id, job info)` in the order of `job_ids` (consumed lazily), infos are requested concurrently.
+    Removed jobs and jobs which info can't be received are skipped.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    from pownycli import pownyapi
+    from pownycli.util import bounded_map
+    pownyapi.PownySession.reserve(concurrency)
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for (job_id, future) in bounded_map(executor, partial(_get_job_info, powny_server), job_ids, concurrency):
+            job_info = future.result()
+            if job_info is not None:
+                yield job_id, job_info
+
+
+def _iter_chunks(items, size: int):
+    items = iter(items)
+    while True:
+        chunk = list(itertools.islice(items, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _echo_jobs_table(jobs):
+    from pownycli.util import StreamingTable
+    table = StreamingTable()
+    table.add_column('Job', width=36)
+    table.add_column('Method')
+    table.add_column('State', width=len('finished'))
+    table.add_column('Created', width=len('2015-01-01 00:00:00'))
+    for chunk in _iter_chunks(jobs, 100):
+        rows = [[job_id, job_info.get('method', ''), _get_job_state(job_info), job_info.get('created', '')[:19]]
+                for (job_id, job_info) in chunk]
+        click.echo('\n'.join(table.iter_page(rows)))
+
+
+def _echo_jobs_counts(jobs, group_by, top: int):
+    """Only counters are kept, not the jobs"""
+    if group_by is None:
+        click.echo(sum(1 for _ in jobs))
+        return
+    counts = {}
+    for (_, job_info) in jobs:
+        key = _get_job_state(job_info) if group_by == 'state' else job_info.get(group_by)
+        counts[key] = counts.get(key, 0) + 1
+    groups = sorted(counts.items(), key=lambda item: (-item[1], str(item[0])))
+    for (key, count) in (groups[:top] if top else groups):
+        click.echo("{:8} {}".format(count, key))
+
+
 @job.command("list")
-def job_list():
+@click.option('--method', help="Show only jobs of the handlers matching this glob, e.g. `rules.foo.*`")
+@click.option('--state', type=click.Choice(JOB_STATES), help="Show only jobs in this state")
+@click.option('--older-than', callback=_validate_duration, help="Show only jobs created earlier, e.g. `30m`")
+@click.option('--newer-than', callback=_validate_duration, help="Show only jobs created later, e.g. `2h`")
+@click.option('--format', '-o', 'output_format', type=click.Choice(('ids', 'table', 'json')), default='ids',
+              help="Job ids, table or JSON lines with job infos")
+@click.option('--count', is_flag=True, help="Show the amount of jobs instead of them")
+@click.option('--group-by', type=click.Choice(('method', 'state')), help="Count jobs by this field")
+@click.option('--top', type=click.IntRange(0), default=0, help="Show only this amount of the largest groups")
+@click.option('--concurrency', '-n', type=click.IntRange(1), default=10, help="Job info requests running at once")
+def job_list(method, state, older_than, newer_than, output_format, count, group_by, top, concurrency):
     """
-    Show current jobs list by id.
+    Show current jobs.
+    The list is parsed and printed while it is being received. Filters, job infos and grouping require
+    a request per job, they run concurrently.
     """
-    jobs = pownyapi.get_jobs(Settings.get('powny_api_url'))
-    click.echo('\n'.join(list(jobs)))
+    from pownycli import pownyapi
+    if top and group_by is None:
+        raise click.BadParameter("`--top` can be used only with `--group-by`", param_hint="'--top'")
+    powny_server = Settings.get('powny_api_url')
+    if group_by is not None:
+        count = True
+    jobs = pownyapi.iter_jobs(powny_server)
+    filters = {'method': method, 'state': state, 'older_than': older_than, 'newer_than': newer_than}
+    with_filters = any(value is not None for value in filters.values())
+    if with_filters or output_format != 'ids' or group_by is not None:
+        now = dt.utcnow()
+        jobs = _iter_job_infos(powny_server, (job_id for (job_id, _) in jobs), concurrency)
+        if with_filters:
+            jobs = ((job_id, job_info) for (job_id, job_info) in jobs if _match_job(job_info, now, **filters))
+
+    if count:
+        _echo_jobs_counts(jobs, group_by, top)
+    elif output_format == 'table':
+        _echo_jobs_table(jobs)
+    elif output_format == 'json':
+        for (job_id, job_info) in jobs:
+            click.echo(json.dumps(dict(job_info, id=job_id), sort_keys=True))
+    else:
+        for chunk in _iter_chunks(jobs, 1000):
+            click.echo('\n'.join(job_id for (job_id, _) in chunk))
 
 
 @job.command("kill")
-@click.argument('job_id')
-def kill_job(job_id):
+@click.argument('job_ids', nargs=-1)
+@click.option('--from-file', type=click.File('r'), callback=_read_job_ids,
+              help="Take job ids from the first words of lines (e.g. `job list` output), `-` for stdin")
+@click.option('--method', help="Kill only jobs of the handlers matching this glob, e.g. `rules.foo.*`")
+@click.option('--older-than', callback=_validate_duration,
+              help="Kill only jobs created earlier than this time ago, e.g. `30m` or `2h`")
+@click.option('--dry-run', is_flag=True, help="Only print ids of the selected jobs")
+@click.option('--concurrency', '-n', type=click.IntRange(1), default=10, help="Requests running at once")
+@click.option('--retries', type=click.IntRange(0), default=3,
+              help="Retries of a kill while Powny answers `try again`, with exponential backoff")
+def kill_job(job_ids, from_file, method, older_than, dry_run, concurrency, retries):
     """
-    Terminate job by id.
+    Terminate jobs by ids.
+    With `--method` or `--older-than` only the matching jobs are killed, all current jobs are checked
+    if ids are not passed.
     Now, by Powny API limitation, job just marked as `should be deleted`,
     physically it could be deleted for several time or never.
     """
-    pownyapi.terminate_job(Settings.get('powny_api_url'), job_id)
+    from concurrent.futures import ThreadPoolExecutor
+    from pownycli import pownyapi
+    from pownycli.util import bounded_map
+
+    powny_server = Settings.get('powny_api_url')
+    job_ids = list(OrderedDict.fromkeys(job_ids + tuple(from_file)))
+    with_filters = method is not None or older_than is not None
+    if not job_ids:
+        if not with_filters:
+            raise click.BadParameter("Pass job ids as arguments, with `--from-file` or select them by filters")
+        job_ids = (job_id for (job_id, _) in pownyapi.iter_jobs(powny_server))
+    pownyapi.PownySession.reserve(concurrency)
+    if with_filters:
+        now = dt.utcnow()
+        job_ids = [job_id for (job_id, job_info) in _iter_job_infos(powny_server, job_ids, concurrency)
+                   if _match_job(job_info, now, method=method, older_than=older_than)]
+        logger.info("%d jobs selected", len(job_ids))
+    if dry_run:
+        if job_ids:
+            click.echo('\n'.join(job_ids))
+        return
+
+    killed, missing, failed = 0, 0, 0
+    kill = partial(pownyapi.terminate_job, powny_server, retries=retries,
+                   backoff_factor=pownyapi.PownySession.get_option('backoff_factor'))
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for (job_id, future) in bounded_map(executor, kill, job_ids, concurrency):
+            try:
+                if future.result():
+                    killed += 1
+                else:
+                    missing += 1
+            except pownyapi.PownyAPIException as error:
+                failed += 1
+                logger.error("Can't kill job %s: %s", job_id, error)
+
+    if len(job_ids) > 1:
+        logger.info("Killed %d jobs, %d not found, %d failed", killed, missing, failed)
+    if failed:
+        raise pownyapi.PownyAPIException("{} of {} jobs were not killed".format(failed, len(job_ids)))
 
 
 @job.command("send-event")
 @click.argument('event_args', nargs=-1, required=False)
 @click.option('--file', '-f', callback=_validate_event_desc, type=click.File('r'),
-              help="Path to JSON file with event description")
-def send_event(event_args, file):
+              help="Path to JSON or newline-delimited JSON file with events, `-` for stdin")
+@click.option('--concurrency', '-n', type=click.IntRange(1), default=1,
+              help="Amount of events posted in parallel")
+def send_event(event_args, file, concurrency):
     """
     Send event to Powny via API.
     Could be called with arguments `host service status` or with JSON file event description.
+    Ids of the spawned jobs are printed to stdout as `job_id method` lines.
     """
+    from concurrent.futures import ThreadPoolExecutor
+    from pownycli import pownyapi
+    from pownycli.util import bounded_map
 
     events = file or _get_event_from_args(event_args)
+    powny_server = Settings.get('powny_api_url')
+    pownyapi.PownySession.reserve(concurrency)
+
+    sent, failed = 0, 0
+    started = time.time()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for (event, future) in bounded_map(executor, partial(_send_event, powny_server), events, concurrency):
+            try:
+                jobs = future.result()
+            except pownyapi.PownyAPIException as error:
+                failed += 1
+                logger.error("Can't send event %s: %s", event, error)
+            else:
+                sent += 1
+                for (job_id, job_info) in jobs.items():
+                    click.echo("{} {}".format(job_id, job_info['method']))
+    elapsed = time.time() - started
+
+    if sent + failed > 1:
+        logger.info("Sent %d events, %d failed in %.2f sec (%.1f events/sec)",
+                    sent, failed, elapsed, (sent + failed) / elapsed if elapsed else 0)
+    if failed:
+        raise pownyapi.PownyAPIException("{} of {} events were not sent".format(failed, sent + failed))
+
+
+@cli.command("replay")
+@click.argument('events_file', type=click.File('r'), callback=_validate_event_desc)
+@click.option('--target', type=click.Choice(('api', 'local')), default='api',
+              help="Send events to Powny API or execute them by the local rules")
+@click.option('--speed', type=float, default=1.0,
+              help="Playback speed multiplier, e.g. `10` is ten times faster; `0` ignores the events' time")
+@click.option('--rate', type=float, help="Maximum events per second")
+@click.option('--burst', type=click.IntRange(1), default=1, help="Events allowed at once above `--rate`")
+@click.option('--time-field', default='timestamp', help="Field with the event's time: UNIX time or ISO 8601, UTC")
+@click.option('--concurrency', '-n', type=click.IntRange(1), default=10,
+              help="Events sent to Powny API at once, local rules execute them one by one")
+@click.option('--stats-interval', type=float, default=5.0, help="Interval of stats reports, sec")
+@click.option('--index/--no-index', default=False, help="Match events through the index of handlers (local)")
+@click.option('--offline', is_flag=True, help="Use only the cached cluster config for the local rules")
+def replay_events(events_file, target, speed, rate, burst, time_field, concurrency, stats_interval, index, offline):
+    """
+    Replay timestamped events at their original pace.
+    Events are read from JSON or newline-delimited JSON file (`-` for stdin) and sent at the same intervals
+    as their times (`--speed` scales them), but not faster than `--rate`. Rate, latency percentiles
+    and errors are reported while the events are replayed.
+    """
+    from pownycli import replay
+    if speed < 0 or (rate is not None and rate <= 0):
+        raise click.BadParameter("`--speed` can't be negative and `--rate` must be positive")
+    if target == 'local':
+        from pownycli import checker
+        _check_rules_repo()
+        send = checker.make_executor(Settings.config, use_index=index, offline=offline)
+        concurrency = 1
+    else:
+        from pownycli import pownyapi
+        powny_server = Settings.get('powny_api_url')
+        pownyapi.PownySession.reserve(concurrency)
+        send = partial(_send_event, powny_server)
 
-    for event in events:
-        if 'description' not in event:
-            event['description'] = ''
-        logger.info("Send event: {}".format(event))
-        pownyapi.send_event(Settings.get('powny_api_url'), event)
+    stats = replay.replay(events_file, send, time_field=time_field, speed=speed, rate=rate, burst=burst,
+                          concurrency=concurrency, stats_interval=stats_interval)
+    if stats['errors']:
+        raise replay.ReplayError("{} of {} events failed".format(stats['errors'], stats['events']))
+
+
+_SHELL_HISTORY = '~/.config/powny-cli/shell_history'
+# `--help` exits through `ctx.exit()`, it is `click.exceptions.Exit` in click 7+ and `sys.exit()` before
+_EXIT_ERRORS = (SystemExit, getattr(click.exceptions, 'Exit', SystemExit))
+
+
+def _setup_history():
+    """Line editing and history through `readline` if it is available, returns the function saving history"""
+    try:
+        import readline
+    except ImportError:
+        return lambda: None
+    path = os.path.expanduser(_SHELL_HISTORY)
+    try:
+        readline.read_history_file(path)
+    except (IOError, OSError):
+        pass
+
+    def save():
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            readline.write_history_file(path)
+        except (IOError, OSError) as error:
+            logger.debug("Can't save shell history: %s", error)
+    return save
+
+
+def _run_shell_line(ctx, line: str):
+    """Run one line of `powny shell` as `powny` command in the context of the shell's parent"""
+    import shlex
+    try:
+        args = shlex.split(line)
+    except ValueError as error:
+        raise click.UsageError(str(error))
+    if not args:
+        return
+    if args[0].startswith('-'):
+        raise click.UsageError("Global options are passed to `powny shell` itself")
+    if args[0] == 'help':
+        click.echo(ctx.get_help())
+        return
+    name, command, args = cli.resolve_command(ctx, args)
+    if command is shell:
+        raise click.UsageError("Shell is already running")
+    # The group's callback isn't invoked again, so the settings, caches and connections stay warm
+    with command.make_context(name, args, parent=ctx) as command_ctx:
+        command.invoke(command_ctx)
+
+
+@cli.command()
+@click.option('--load-rules', is_flag=True, help="Load the rules at start, not at the first `rules exec`")
+@click.option('--offline', is_flag=True, help="Load the rules with the cached cluster config only")
+@click.pass_context
+def shell(ctx, load_rules, offline):
+    """
+    Run commands interactively in one process.
+    Commands are typed without `powny` and global options, e.g. `job list --count`.
+    The settings are loaded once, HTTP connections to Powny API are kept open between commands
+    and the rules are loaded by the first `rules exec`; then only changed rule modules are reloaded.
+    Type `help` for the list of commands, `exit` or Ctrl-D to quit.
+    """
+    from pownycli import pownyapi
+    pownyapi.PownySession.get_session()
+    if load_rules:
+        from pownycli import checker
+        _check_rules_repo()
+        exposed = checker.preload(Settings.config, offline)
+        logger.info("%d handlers loaded", len(exposed.get('handlers', {})))
+
+    interactive = sys.stdin.isatty()
+    save_history = _setup_history() if interactive else lambda: None
+    prompt = 'powny> ' if interactive else ''
+    try:
+        while True:
+            try:
+                line = input(prompt)
+            except EOFError:
+                if interactive:
+                    click.echo()
+                return
+            except KeyboardInterrupt:
+                click.echo()
+                continue
+            if line.strip() in ('exit', 'quit'):
+                return
+            try:
+                _run_shell_line(ctx.parent, line)
+            except click.ClickException as error:
+                error.show()
+            except click.Abort:
+                click.echo("Aborted!", err=True)
+            except KeyboardInterrupt:
+                click.echo()
+            except _EXIT_ERRORS:
+                pass
+            except Exception as error:
+                logger.error("Error occurred: %s", error)
+                logger.debug("Traceback of the error", exc_info=True)
+    finally:
+        save_history()
 
 
 def main():
@@ -0,0 +1,7 @@
+"""
+Values shared by the commands and the modules implementing them.
+This module has no dependencies, so `client` imports it without slowing the startup down.
+"""
+
+# When the new HEAD may be set: pushed to all Powny remotes, to the majority of them or to any one
+PUSH_POLICIES = ('all', 'quorum', 'any')
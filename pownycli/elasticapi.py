@@ -0,0 +1,235 @@
+"""
+This module is wrapper to Elasticsearch API with Powny logs.
+"""
+
+import re
+import json
+import time
+import logging
+import requests
+from datetime import datetime, timedelta
+from requests.compat import urljoin
+from pownycli.pownyapi import PownySession
+
+
+logger = logging.getLogger(__name__)
+
+# How long Elasticsearch keeps the search context between pages
+SCROLL_TTL = '1m'
+# More indices are searched through a wildcard of the index pattern to keep URL short
+MAX_INDICES = 50
+TIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+class ElasticAPIException(Exception):
+    pass
+
+
+def _safe_request(req, msg, *args, **kwargs):
+    try:
+        resp = req(*args, **kwargs)
+    except (requests.ConnectionError, requests.Timeout):
+        raise ElasticAPIException("Connection error while execute request: {}".format(args[0]))
+    try:
+        resp.raise_for_status()
+    except requests.HTTPError:
+        logger.error("Something goes wrong: {}".format(resp.content))
+        raise ElasticAPIException(msg)
+    return resp.json()
+
+
+def _clear_scroll(elastic_url: str, scroll_id: str):
+    try:
+        PownySession.delete(urljoin(elastic_url, '/_search/scroll'), data=json.dumps({'scroll_id': [scroll_id]}))
+    except (requests.ConnectionError, requests.Timeout) as error:
+        # The search context is released by Elasticsearch after `SCROLL_TTL` anyway
+        logger.debug("Can't clear scroll: %s", error)
+
+
+def get_indices(pattern: str, since: datetime, until=None):
+    """
+    Names of time-based indices made by strftime `pattern` which cover the time since `since` until `until` (now).
+    A wildcard is returned instead of a too long list.
+    """
+    until = until or datetime.utcnow()
+    step = timedelta(hours=1) if '%H' in pattern else timedelta(days=1)
+    names = []
+    current = since
+    while current < until + step:
+        name = min(current, until).strftime(pattern)
+        if name not in names:
+            names.append(name)
+            if len(names) > MAX_INDICES:
+                return [get_wildcard(pattern)]
+        current += step
+    return names
+
+
+def get_wildcard(pattern: str):
+    # Directives with the separators between them, e.g. `%Y.%m.%d`
+    return re.sub(r'%.([^%]*%.)*', '*', pattern)
+
+
+def format_time(value: datetime):
+    return value.strftime(TIME_FORMAT)
+
+
+def parse_time(value: str):
+    return datetime.strptime(value, TIME_FORMAT)
+
+
+def _latest(*values):
+    values = [value for value in values if value is not None]
+    return max(values) if values else None
+
+
+class JobLogsQuery:
+    """
+    Search of log records of one or several jobs in filter context, so Elasticsearch can cache it.
+    Records are sorted by time, with `group` they are sorted by job id first.
+    `since` and `until` limit the time of the records.
+    With `index_pattern` (strftime pattern of time-based indices) only the indices since `index_since` or `since`
+    until `until` are searched, or all indices of the pattern if the time is unknown.
+    Without it all indices are searched.
+    """
+
+    def __init__(self, job_ids, since=None, until=None, index_pattern=None, index_since=None,
+                 job_id_field='job_id.raw', group=False):
+        self.job_ids = list(job_ids)
+        self.since = since
+        self.until = until
+        self.index_pattern = index_pattern
+        self.index_since = index_since or since
+        self.job_id_field = job_id_field
+        # Not analyzed subfield (`job_id.raw`, `job_id.keyword`) is searched, the record has the value itself
+        self.source_field = re.sub(r'\.(raw|keyword)$', '', job_id_field)
+        self.group = group
+
+    def get_job_id(self, hit: dict):
+        """Job id of the record (hit) or None"""
+        value = hit['_source']
+        for key in self.source_field.split('.'):
+            if not isinstance(value, dict):
+                return None
+            value = value.get(key)
+        return value
+
+    def get_path(self, after=None):
+        """Search path for records after `after` (datetime)"""
+        if not self.index_pattern:
+            return '/_all/_search'
+        since = _latest(self.index_since, after)
+        if since is None:
+            indices = [get_wildcard(self.index_pattern)]
+        else:
+            indices = get_indices(self.index_pattern, since, self.until)
+        return '/{}/_search'.format(','.join(indices))
+
+    def get_body(self, size: int, after=None, latest=False):
+        """With `latest` the newest records come first"""
+        conditions = [{'terms': {self.job_id_field: self.job_ids}}]
+        time_range = {}
+        since = _latest(self.since, after)
+        if since is not None:
+            time_range['gte'] = format_time(since)
+        if self.until is not None:
+            time_range['lte'] = format_time(self.until)
+        if time_range:
+            conditions.append({'range': {'@timestamp': time_range}})
+        sort = [{'@timestamp': {'order': 'desc' if latest else 'asc'}}]
+        if self.group:
+            sort.insert(0, {self.job_id_field: {'order': 'asc'}})
+        return {'query': {'constant_score': {'filter': {'bool': {'must': conditions}}}}, 'size': size, 'sort': sort}
+
+
+def _search(elastic_url: str, query: JobLogsQuery, size: int, after=None, latest=False, **params):
+    return _safe_request(PownySession.post, "Can't get logs of jobs {}".format(', '.join(query.job_ids)),
+                         urljoin(elastic_url, query.get_path(after)), params=dict(params, ignore_unavailable='true'),
+                         headers={'content-type': 'application/json'},
+                         data=json.dumps(query.get_body(size, after, latest)))
+
+
+def iter_job_logs(elastic_url: str, query: JobLogsQuery, limit=0, page_size=500):
+    """
+    Yield pages of job's log records (hits) sorted by `@timestamp` on the server side.
+    Pages are fetched through the scroll API one by one, so memory doesn't depend on the amount of records.
+    `limit` is the maximum amount of records, `0` for all of them.
+    """
+    size = min(page_size, limit) if limit else page_size
+    result = _search(elastic_url, query, size, scroll=SCROLL_TTL)
+    scroll_id = result.get('_scroll_id')
+    returned = 0
+    try:
+        while True:
+            hits = result['hits']['hits']
+            last_page = len(hits) < size
+            if limit:
+                hits = hits[:limit - returned]
+                last_page = last_page or returned + len(hits) >= limit
+            if hits:
+                returned += len(hits)
+                yield hits
+            if last_page or not hits or scroll_id is None:
+                return
+            result = _safe_request(PownySession.get, "Can't get logs of jobs {}".format(', '.join(query.job_ids)),
+                                   urljoin(elastic_url, '/_search/scroll'),
+                                   params={'scroll': SCROLL_TTL, 'scroll_id': scroll_id})
+            scroll_id = result.get('_scroll_id', scroll_id)
+    finally:
+        if scroll_id is not None:
+            _clear_scroll(elastic_url, scroll_id)
+
+
+def _advance(since, seen: set, hits):
+    """
+    Move the cursor to the last record of the page.
+    Timestamps are not unique, so ids of the records with the last timestamp are remembered too.
+    """
+    last = hits[-1]['_source']['@timestamp']
+    if last != since:
+        seen = set()
+    seen.update(hit['_id'] for hit in hits if hit['_source']['@timestamp'] == last)
+    return last, seen
+
+
+def _iter_last_job_logs(elastic_url: str, query: JobLogsQuery, limit: int):
+    """The page of the last `limit` records, sorted by time"""
+    hits = _search(elastic_url, query, limit, latest=True)['hits']['hits']
+    if hits:
+        yield hits[::-1]
+
+
+def follow_job_logs(elastic_url: str, query: JobLogsQuery, limit=0, page_size=500, interval=1.0, max_interval=10.0):
+    """
+    Yield pages of the existing records like `iter_job_logs()`, then poll for newer ones endlessly.
+    With `limit` only the last `limit` existing records are yielded (like `tail -f -n`), new ones are not limited.
+    The records must be sorted only by time, i.e. `query` can't be grouped.
+    Each poll is one query for the records since the last seen `@timestamp`, only in the indices of this time.
+    If nothing is found, the interval is doubled up to `max_interval`.
+    """
+    assert not query.group, "Grouped records can't be followed by time"
+    since, seen = None, set()
+    if limit:
+        existing = _iter_last_job_logs(elastic_url, query, limit)
+    else:
+        existing = iter_job_logs(elastic_url, query, 0, page_size)
+    for hits in existing:
+        since, seen = _advance(since, seen, hits)
+        yield hits
+
+    delay = interval
+    while True:
+        # Already seen records are returned again, so they must not fill the page
+        size = page_size + len(seen)
+        result = _search(elastic_url, query, size, after=since and parse_time(since))
+        found = result['hits']['hits']
+        hits = [hit for hit in found if hit['_id'] not in seen]
+        if hits:
+            since, seen = _advance(since, seen, hits)
+            yield hits
+            delay = interval
+            if len(found) == size:  # There are more records right now
+                continue
+        time.sleep(delay)
+        if not hits:
+            delay = min(delay * 2, max_interval)
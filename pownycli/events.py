@@ -0,0 +1,64 @@
+"""
+This module reads event descriptions from files.
+"""
+
+import json
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+
+class EventParseError(ValueError):
+    pass
+
+
+def _as_list(value):
+    if isinstance(value, list):
+        return value
+    return [value]
+
+
+def _parse_document(name: str, text: str):
+    try:
+        return _as_list(json.loads(text))
+    except ValueError as error:
+        raise EventParseError("Can't parse event description file {}: {}".format(name, error))
+
+
+def iter_events(stream):
+    """
+    Yield events from `stream` one by one.
+    Newline-delimited JSON (an object or a list of objects per line) is parsed lazily, line by line,
+    so the first event is available immediately and memory doesn't depend on the file size.
+    A JSON object or a list of objects spread over several lines is read as a whole.
+    """
+    name = getattr(stream, 'name', '<stream>')
+    line_number = 0
+    first_line = ''
+    while not first_line.strip():
+        first_line = stream.readline()
+        line_number += 1
+        if not first_line:
+            return
+
+    try:
+        first = json.loads(first_line)
+    except ValueError:
+        logger.debug("%s is not newline-delimited JSON, read it as a single document", name)
+        for event in _parse_document(name, first_line + stream.read()):
+            yield event
+        return
+
+    for event in _as_list(first):
+        yield event
+    for line in stream:
+        line_number += 1
+        if not line.strip():
+            continue
+        try:
+            value = json.loads(line)
+        except ValueError as error:
+            raise EventParseError("Can't parse event at {}:{}: {}".format(name, line_number, error))
+        for event in _as_list(value):
+            yield event
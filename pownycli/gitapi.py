@@ -1,11 +1,19 @@
 """
 This module is for upload updated or new rules to Powny.
+HEAD, refs and the index are read in-process through `gitrepo`, `git` is run only for status, commits
+and network operations.
 """
 
-import envoy
 import logging
+import struct
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from pownycli import pownyapi
+from pownycli import gitrepo
+from pownycli.constants import PUSH_POLICIES
 from pownycli.settings import Settings
+from pownycli.util import bounded_map
 
 logger = logging.getLogger(__name__)
 
@@ -33,10 +41,11 @@ def _show_rules_info(powny_server: str):
                 logger.debug(" --- %s", func_name)
 
 
-def _update_head(powny_server: str, path: str):
-    new_head = _execute_git_command("rev-parse HEAD", path, err_msg="Can't update HEAD").strip()
+def _update_head(powny_server: str, path: str, current_head=None):
+    new_head = get_head(path)
     logger.debug("Local HEAD is %s", new_head)
-    current_head = pownyapi.get_rules_info(powny_server)['head']
+    if current_head is None:
+        current_head = pownyapi.get_rules_info(powny_server)['head']
     logger.debug("Remote HEAD is %s", current_head)
     if new_head == current_head:
         logger.info("HEAD already updated")
@@ -46,15 +55,22 @@ def _update_head(powny_server: str, path: str):
     _show_rules_info(powny_server)
 
 
-def _execute_git_command(cmd: str, path, err_msg: str):
+def _execute_git_command(args, path, err_msg: str, timeout=None):
     git_warn_exit_code = 1
-    if path is not None:
-        full_cmd = 'git --git-dir={path}/.git --work-tree={path} {cmd}'.format(cmd=cmd, path=path)
-    else:
-        full_cmd = cmd
-    logger.debug("Execute command: %s", full_cmd)
-    result = envoy.run(full_cmd)
-    out, err, exit_code = result.std_out, result.std_err, result.status_code
+    cmd = ['git'] + list(args)
+    logger.debug("Execute command: %s (in %s)", ' '.join(cmd), path or '.')
+    try:
+        process = subprocess.Popen(cmd, cwd=path, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE, universal_newlines=True)
+    except OSError as error:
+        raise GitCommandError("{}: {}".format(err_msg, error))
+    try:
+        out, err = process.communicate(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.communicate()
+        raise GitCommandError("{} (timed out after {} sec)".format(err_msg, timeout))
+    exit_code = process.returncode
     _multiline_log(logging.DEBUG, "Git stdout: %s", out)
     if exit_code > git_warn_exit_code:
         _multiline_log(logging.ERROR, "Git stderr: %s", err)
@@ -70,55 +86,177 @@ def _execute_git_command(cmd: str, path, err_msg: str):
         return out
 
 
+def _read_head(path: str):
+    try:
+        return gitrepo.read_head(path)
+    except (OSError, gitrepo.GitRepoError) as error:
+        logger.debug("Can't read HEAD of %s: %s, asking git", path, error)
+        head = _execute_git_command(['rev-parse', '--verify', '-q', 'HEAD'], path, "Can't get HEAD").strip()
+        branch = _execute_git_command(['rev-parse', '--abbrev-ref', 'HEAD'], path, "Can't get current branch").strip()
+        return (None if branch == 'HEAD' else branch), (head or None)
+
+
 def _get_current_branch(path):
-    return _execute_git_command("rev-parse --abbrev-ref HEAD", path, "Can't get current branch").strip()
+    return _read_head(path)[0] or 'HEAD'  # The same as `git rev-parse --abbrev-ref HEAD`
+
 
+def get_head(path: str):
+    head = _read_head(path)[1]
+    if head is None:
+        raise GitCommandError("There are no commits in {}".format(path))
+    return head
 
-def get_root(fallback):
+
+def get_blob_hashes(path: str):
+    """
+    Return `{absolute file path: git blob hash}` for tracked files without unstaged changes.
+    For such files the blob in the index is exactly the content of the working tree.
+    """
     try:
-        return _execute_git_command('git rev-parse --show-toplevel', None, "Can't find Git repo").strip()
-    except GitCommandError:
-        return fallback
+        return gitrepo.get_clean_blobs(path)
+    except (OSError, ValueError, struct.error, gitrepo.GitRepoError) as error:
+        raise GitCommandError("Can't read git index: {}".format(error))
 
 
 def add(path: str, file_name: str):
-    _execute_git_command('add {name}'.format(name=file_name), path, "Can't add file %s" % file_name)
+    _execute_git_command(['add', '--', file_name], path, "Can't add file %s" % file_name)
     logger.info("New rule %s added", file_name)
 
 
-def upload(powny_server: str, path: str, force: bool):
+def _push_to_remote(path: str, branch: str, force: bool, timeout, repo: str):
+    cmd = ['push', '--force'] if force else ['push']
+    _execute_git_command(cmd + [repo, '{}:master'.format(branch)], path, "Can't push to Powny remote {}".format(repo),
+                         timeout)
+
+
+def is_policy_met(policy: str, pushed: int, total: int):
+    if policy not in PUSH_POLICIES:
+        raise ValueError("Unknown push policy: {}".format(policy))
+    if policy == 'all':
+        return pushed == total
+    elif policy == 'quorum':
+        return pushed > total // 2
+    return pushed > 0
+
+
+def push_to_remotes(path: str, repos, branch: str, force: bool, concurrency=4, timeout=None):
+    """
+    Push `branch` to master of each Powny remote, at most `concurrency` pushes at once.
+    Each push is killed after `timeout` seconds. Return `{repo: error}` for the failed pushes.
+    """
+    failed = {}
+    push = partial(_push_to_remote, path, branch, force, timeout)
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for (repo, future) in bounded_map(executor, push, repos, concurrency):
+            error = future.exception()
+            if error is None:
+                logger.info("Rules uploaded to %s", repo)
+            else:
+                logger.error("Can't upload rules to %s: %s", repo, error)
+                failed[repo] = error
+    return failed
+
+
+def _is_ancestor(path: str, commit: str):
+    """Is `commit` already in the history of local HEAD, False for unknown commits too"""
+    return subprocess.call(['git', 'merge-base', '--is-ancestor', commit, 'HEAD'], cwd=path,
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL) == 0
+
+
+def _ls_remote(path: str, timeout, target):
+    repo, ref = target
+    out = _execute_git_command(['ls-remote', repo, ref], path, "Can't list refs of {}".format(repo), timeout)
+    for line in out.splitlines():
+        (value, name) = line.split('\t', 1)
+        if name == ref:
+            return value
+    return None
+
+
+def get_remote_heads(path: str, targets, concurrency=4, timeout=None):
+    """
+    Run `git ls-remote` for each `(repo, ref)` of `targets`, at most `concurrency` at once.
+    Return `{(repo, ref): hash}`, the hash is None if there is no such ref or if the remote is unavailable.
+    """
+    heads = {}
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for (target, future) in bounded_map(executor, partial(_ls_remote, path, timeout), targets, concurrency):
+            error = future.exception()
+            if error is not None:
+                logger.warning("Can't get HEAD of %s: %s", target[0], error)
+            heads[target] = None if error else future.result()
+    return heads
+
+
+def upload(powny_server: str, path: str, force: bool, policy='all', concurrency=4, timeout=None, preflight=None):
     """
     This function execute git commands:
-        - git pull --rebase
-        - git push # to origin
-        - git push ssh://git@powny/remote.git # to each Powny git
-    and POST new HEAD hash to Powny via API
+        - git pull --rebase # if origin has new commits
+        - git push # to origin, if it is behind
+        - git push ssh://git@powny/remote.git # to each Powny git which is behind, concurrently
+    and POST new HEAD hash to Powny via API if the pushes satisfy `policy` (see `PUSH_POLICIES`).
+    The refs of all remotes are listed first by `git ls-remote` in parallel, so a repeated upload does nothing.
+    `preflight()` checks the rules after the pull, i.e. the tree which is pushed, if anything is to be pushed;
+    it raises to stop the upload.
     """
-    status = _execute_git_command('status --porcelain', path, "Can't get git status")
+    status = _execute_git_command(['status', '--porcelain'], path, "Can't get git status")
     current_branch = _get_current_branch(path)
 
     if len(status) > 0:
         logger.info("You have uncommited changes in working directory. Please commit them before upload.")
         raise GitCommandError
 
-    logger.info("Pull changes from rules server...")
+    powny_repos = Settings.get("powny_git_remotes")
+    assert powny_repos, "Powny git remotes does not defined. Can't upload rules."
+
+    logger.info("Compare local HEAD with remotes...")
+    origin = ('origin', 'refs/heads/{}'.format(current_branch))
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        rules_info = executor.submit(pownyapi.get_rules_info, powny_server)
+        heads = get_remote_heads(path, [origin] + [(repo, 'refs/heads/master') for repo in powny_repos],
+                                 concurrency + 1, timeout)
+        powny_head = rules_info.result()['head']
+    skipped = []
 
-    _execute_git_command('pull --rebase origin {}'.format(current_branch), path,
-                         "Can't pull changes from server rules")
+    local_head = get_head(path)
+    if heads[origin] is None or heads[origin] == local_head or _is_ancestor(path, heads[origin]):
+        # Unavailable origin is reported by the push
+        skipped.append('pull')
+    else:
+        logger.info("Pull changes from rules server...")
+        _execute_git_command(['pull', '--rebase', 'origin', current_branch], path,
+                             "Can't pull changes from server rules")
+        local_head = get_head(path)
 
-    logger.info("Sync you changes with rules server...")
+    behind = [repo for repo in powny_repos if heads[(repo, 'refs/heads/master')] != local_head]
+    if preflight is not None and (heads[origin] != local_head or behind):
+        preflight()
 
-    cmd = 'push --force origin {}' if force else 'push origin {}'
-    _execute_git_command(cmd.format(current_branch), path, "Can't push your changes")
+    if heads[origin] == local_head:
+        skipped.append('push to origin')
+    else:
+        logger.info("Sync you changes with rules server...")
+        cmd = ['push', '--force'] if force else ['push']
+        _execute_git_command(cmd + ['origin', current_branch], path, "Can't push your changes")
 
-    powny_repos = Settings.get("powny_git_remotes")
-    assert powny_repos, "Powny git remotes does not defined. Can't upload rules."
-    for repo in powny_repos:
-        logger.info("Upload rules to {}...".format(repo))
-        cmd = 'push --force {} {}:master' if force else 'push {} {}:master'
-        _execute_git_command(cmd.format(repo, current_branch), path, "Can't push to Powny remote")
+    if len(behind) < len(powny_repos):
+        up_to_date = len(powny_repos) - len(behind)
+        skipped.append('push to {} of {} up-to-date Powny remotes'.format(up_to_date, len(powny_repos)))
+    failed = {}
+    if behind:
+        logger.info("Upload rules to %d Powny remotes...", len(behind))
+        failed = push_to_remotes(path, behind, current_branch, force, concurrency, timeout)
+    pushed = len(powny_repos) - len(failed)
+    if not is_policy_met(policy, pushed, len(powny_repos)):
+        raise GitCommandError("Rules uploaded to {} of {} Powny remotes, HEAD is not updated (policy: {})".format(
+            pushed, len(powny_repos), policy))
+    if failed:
+        logger.warning("Rules uploaded to %d of %d Powny remotes, failed: %s",
+                       pushed, len(powny_repos), ', '.join(sorted(failed)))
+    if skipped:
+        logger.info("Already up to date, skipped: %s", ', '.join(skipped))
 
     logger.debug("Update head...")
-    _update_head(powny_server, path)
+    _update_head(powny_server, path, powny_head)
 
     logger.info("You rules uploaded to Powny!")
@@ -0,0 +1,190 @@
+"""
+This module reads a git repository in-process: the work tree root, HEAD, refs and the index.
+
+They are small files, reading them is much cheaper than spawning `git` for every query
+(and the CLI looks for the work tree root on every invocation). Unsupported layouts (reftable refs,
+split index) raise `GitRepoError`: `gitapi` asks `git` itself for HEAD then and reports a broken index.
+Everything else, e.g. commits and network operations, is run by `git`, see `gitapi`.
+"""
+
+import os
+import struct
+import binascii
+from collections import namedtuple
+
+_ENTRY_HEADER = struct.Struct('>10I20sH')
+_ASSUME_VALID = 0x8000
+_EXTENDED = 0x4000
+_SKIP_WORKTREE = 0x4000
+_INTENT_TO_ADD = 0x2000
+_REGULAR_FILE = 0o100000
+
+IndexEntry = namedtuple('IndexEntry', ('path', 'blob', 'mtime', 'size', 'ino', 'mode', 'flags'))
+
+
+class GitRepoError(Exception):
+    pass
+
+
+def find_root(path: str):
+    """Root of the work tree containing `path` (like `git rev-parse --show-toplevel`) or None"""
+    path = os.path.abspath(path)
+    while True:
+        if os.path.exists(os.path.join(path, '.git')):
+            return path
+        parent = os.path.dirname(path)
+        if parent == path:
+            return None
+        path = parent
+
+
+def get_git_dir(root: str):
+    git_dir = os.path.join(root, '.git')
+    if os.path.isfile(git_dir):
+        # Worktrees and submodules have a file pointing to the real git dir
+        with open(git_dir) as git_file:
+            line = git_file.readline().strip()
+        if not line.startswith('gitdir:'):
+            raise GitRepoError("Invalid gitfile {}".format(git_dir))
+        git_dir = os.path.join(root, line[len('gitdir:'):].strip())
+    if not os.path.isdir(git_dir):
+        raise GitRepoError("{} is not a git repository".format(root))
+    return git_dir
+
+
+def _get_common_dir(git_dir: str):
+    try:
+        with open(os.path.join(git_dir, 'commondir')) as common_file:
+            return os.path.normpath(os.path.join(git_dir, common_file.read().strip()))
+    except FileNotFoundError:
+        return git_dir
+
+
+def _read_packed_ref(common_dir: str, ref: str):
+    try:
+        with open(os.path.join(common_dir, 'packed-refs')) as packed_file:
+            for line in packed_file:
+                if line.startswith(('#', '^')):
+                    continue
+                parts = line.split()
+                if len(parts) == 2 and parts[1] == ref:
+                    return parts[0]
+    except FileNotFoundError:
+        pass
+    return None
+
+
+def _read_ref(git_dir: str, ref: str):
+    """Resolve `ref` (e.g. `HEAD` or `refs/heads/master`) to `(name of the last symbolic ref target, hash)`"""
+    common_dir = _get_common_dir(git_dir)
+    for _ in range(5):  # Like git, don't follow symbolic refs endlessly
+        value = None
+        for base_dir in (git_dir, common_dir):
+            try:
+                with open(os.path.join(base_dir, ref)) as ref_file:
+                    value = ref_file.read().strip()
+                break
+            except (FileNotFoundError, NotADirectoryError, IsADirectoryError):
+                continue
+        if value is None:
+            return ref, _read_packed_ref(common_dir, ref)
+        if not value.startswith('ref:'):
+            return ref, value
+        ref = value[len('ref:'):].strip()
+        if ref == 'refs/heads/.invalid':
+            raise GitRepoError("Refs are not stored in files")
+    raise GitRepoError("Too deep symbolic ref {}".format(ref))
+
+
+def read_head(root: str):
+    """Return `(current branch or None if HEAD is detached, hash or None if there are no commits yet)`"""
+    ref, value = _read_ref(get_git_dir(root), 'HEAD')
+    branch = ref[len('refs/heads/'):] if ref.startswith('refs/heads/') else None
+    return branch, value
+
+
+def _read_varint(data: bytes, pos: int):
+    """Offset encoding of git, used for prefix compressed paths of index v4"""
+    byte = data[pos]
+    pos += 1
+    value = byte & 0x7f
+    while byte & 0x80:
+        byte = data[pos]
+        pos += 1
+        value = ((value + 1) << 7) | (byte & 0x7f)
+    return value, pos
+
+
+def iter_index(root: str):
+    """Yield `IndexEntry` for every entry of the index (`.git/index`, versions 2-4)"""
+    try:
+        with open(os.path.join(get_git_dir(root), 'index'), 'rb') as index_file:
+            data = index_file.read()
+    except FileNotFoundError:
+        return
+    signature, version, count = struct.unpack_from('>4sII', data)
+    if signature != b'DIRC' or version not in (2, 3, 4):
+        raise GitRepoError("Unsupported index format")
+
+    pos = 12
+    path = b''
+    for _ in range(count):
+        fields = _ENTRY_HEADER.unpack_from(data, pos)
+        start = pos
+        pos += _ENTRY_HEADER.size
+        flags = fields[11]
+        if version >= 3 and flags & _EXTENDED:
+            flags |= struct.unpack_from('>H', data, pos)[0] << 16
+            pos += 2
+        if version == 4:
+            strip, pos = _read_varint(data, pos)
+            end = data.index(b'\0', pos)
+            path = path[:len(path) - strip] + data[pos:end]
+            pos = end + 1
+        else:
+            end = data.index(b'\0', pos)
+            path = data[pos:end]
+            pos = start + (end - start + 8) // 8 * 8  # Entries are padded with NULs to 8 bytes
+        yield IndexEntry(path.decode('utf-8', 'surrogateescape'), binascii.hexlify(fields[10]).decode(),
+                         (fields[2], fields[3]), fields[9], fields[5], fields[6], flags)
+
+    # Entries of a split index are partially stored in the shared index
+    while pos + 8 <= len(data) - 20:
+        name, size = struct.unpack_from('>4sI', data, pos)
+        if name == b'link':
+            raise GitRepoError("Split index is not supported")
+        pos += 8 + size
+
+
+def get_clean_blobs(root: str):
+    """
+    Return `{absolute file path: blob hash}` for tracked files, which are unchanged since they were staged
+    according to their size and mtime, as git decides it. Files modified not before the index was written
+    ("racily clean") and other questionable entries are omitted, so the result is always safe to use.
+    """
+    root = os.path.abspath(root)
+    index_path = os.path.join(get_git_dir(root), 'index')
+    try:
+        index_mtime = os.stat(index_path).st_mtime_ns
+    except FileNotFoundError:
+        return {}
+
+    blobs = {}
+    for entry in iter_index(root):
+        if (entry.flags >> 12) & 0x3 or entry.flags & (_ASSUME_VALID | (_SKIP_WORKTREE << 16)
+                                                       | (_INTENT_TO_ADD << 16)):
+            continue  # Merge conflicts, entries git doesn't compare with files
+        if entry.mode & 0o170000 != _REGULAR_FILE:
+            continue  # Symlinks and submodules
+        file_path = os.path.join(root, entry.path)
+        try:
+            stat = os.lstat(file_path)
+        except OSError:
+            continue
+        # The index keeps only the lower 32 bits of these values
+        seconds, nanoseconds = divmod(stat.st_mtime_ns, 10 ** 9)
+        if ((seconds & 0xffffffff, nanoseconds) != entry.mtime or stat.st_size & 0xffffffff != entry.size
+                or (entry.ino and stat.st_ino & 0xffffffff != entry.ino) or stat.st_mtime_ns >= index_mtime):
+            continue
+        blobs[file_path] = entry.blob
+    return blobs
@@ -0,0 +1,168 @@
+"""
+This module is an index over the handlers' match conditions.
+
+Matchers are opaque callables, so the index learns which event fields each handler reads:
+handlers are evaluated against a copy of the event that records key access.
+The result of a deterministic matcher depends only on the values of the fields it has read,
+so handlers reading the same fields are grouped and each group caches the matched handlers
+by the values of these fields. An event is then matched by one lookup per group.
+Handlers which iterate over the whole event can't be indexed and are always scanned.
+"""
+
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+_MISSING = object()
+
+
+class _TrackingEvent(dict):
+    """
+    Event copy which records keys read by matchers.
+    Access to the whole event (iteration, comparison, copying) makes it `opaque`.
+    """
+
+    def __init__(self, event):
+        super().__init__(event)
+        self.keys_read = set()
+        self.opaque = False
+
+    def __getitem__(self, key):
+        self.keys_read.add(key)
+        return super().__getitem__(key)
+
+    def get(self, key, default=None):
+        self.keys_read.add(key)
+        return super().get(key, default)
+
+    def __contains__(self, key):
+        self.keys_read.add(key)
+        return super().__contains__(key)
+
+    def _read_all(self):
+        self.opaque = True
+
+    def __iter__(self):
+        self._read_all()
+        return super().__iter__()
+
+    def __len__(self):
+        self._read_all()
+        return super().__len__()
+
+    def __eq__(self, other):
+        self._read_all()
+        return super().__eq__(other)
+
+    def __ne__(self, other):
+        self._read_all()
+        return super().__ne__(other)
+
+    def keys(self):
+        self._read_all()
+        return super().keys()
+
+    def values(self):
+        self._read_all()
+        return super().values()
+
+    def items(self):
+        self._read_all()
+        return super().items()
+
+    def copy(self):
+        self._read_all()
+        return super().copy()
+
+
+class HandlerIndex:
+    """
+    Returns names of handlers matched with an event, in the order of `handlers`.
+    With `verify=True` every indexed result is compared with the full scan, mismatches are logged
+    and the full scan result is used.
+    """
+
+    def __init__(self, handlers: dict, check_match, verify=False):
+        self._handlers = handlers
+        self._order = {name: number for (number, name) in enumerate(handlers)}
+        self._check_match = check_match
+        self._verify = verify
+        self._unknown = set(handlers)  # Handlers which have not been evaluated yet
+        self._unindexed = set()
+        self._fields = {}  # Handler name -> fields read by its matchers
+        self._groups = {}  # Fields -> set of handler names
+        self._keys = {}  # Fields -> the same fields in a stable order
+        self._cache = {}  # Fields -> {values of the fields -> matched handler names}
+
+    def match(self, event: dict):
+        matched = set(self._learn(event))
+        for name in self._unindexed:
+            if self._check_match(self._handlers[name], event):
+                matched.add(name)
+        for fields in list(self._groups):
+            matched.update(self._match_group(fields, event))
+
+        result = sorted(matched, key=self._order.get)
+        if self._verify:
+            expected = self.scan(event)
+            if result != expected:
+                logger.error("Handler index mismatch for event %s: indexed %s, scanned %s", event, result, expected)
+                return expected
+        return result
+
+    def scan(self, event: dict):
+        return [name for (name, handler) in self._handlers.items() if self._check_match(handler, event)]
+
+    def _evaluate(self, name, event):
+        """Evaluate handler's matchers and update the fields it depends on"""
+        tracking = _TrackingEvent(event)
+        matched = self._check_match(self._handlers[name], tracking)
+        if tracking.opaque:
+            logger.debug("Handler %s reads the whole event and can't be indexed", name)
+            self._move(name, None)
+        else:
+            fields = frozenset(tracking.keys_read)
+            old = self._fields.get(name)
+            if old is None or not fields <= old:
+                self._move(name, fields if old is None else old | fields)
+        return matched
+
+    def _learn(self, event):
+        for name in list(self._unknown):
+            self._unknown.discard(name)
+            if self._evaluate(name, event):
+                yield name
+
+    def _move(self, name, fields):
+        old = self._fields.pop(name, None)
+        if old is not None:
+            self._groups[old].discard(name)
+            self._cache.pop(old, None)
+            if not self._groups[old]:
+                del self._groups[old]
+                del self._keys[old]
+        if fields is None:
+            self._unindexed.add(name)
+        else:
+            self._fields[name] = fields
+            self._groups.setdefault(fields, set()).add(name)
+            self._keys.setdefault(fields, tuple(sorted(fields, key=str)))
+            self._cache.pop(fields, None)
+
+    def _match_group(self, fields, event):
+        if fields not in self._groups:  # Emptied while matching this event
+            return ()
+        try:
+            key = tuple(event.get(field, _MISSING) for field in self._keys[fields])
+            cache = self._cache.setdefault(fields, {})
+            if key in cache:
+                return cache[key]
+        except TypeError:  # Unhashable values
+            key = cache = None
+
+        matched = frozenset(name for name in list(self._groups[fields]) if self._evaluate(name, event))
+        # Don't cache the result if the group has been changed by the evaluation
+        if cache is not None and self._cache.get(fields) is cache:
+            cache[key] = matched
+        return matched
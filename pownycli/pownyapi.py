@@ -2,22 +2,115 @@
 This module is wrapper to Powny REST API.
 """
 
+import re
 import json
+import time
+import codecs
+import threading
 import requests
 import logging
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+from pownycli.settings import Settings
 
 
 logger = logging.getLogger(__name__)
 
+# A DELETE of a job which timed out may be still in progress on the server, it must not be sent again.
+# The option is called `method_whitelist` before urllib3 1.26.
+if hasattr(Retry, 'DEFAULT_ALLOWED_METHODS'):
+    _RETRY_METHODS = {'allowed_methods': Retry.DEFAULT_ALLOWED_METHODS - {'DELETE'}}
+else:
+    _RETRY_METHODS = {'method_whitelist': Retry.DEFAULT_METHOD_WHITELIST - {'DELETE'}}
+
 
 class PownyAPIException(Exception):
     pass
 
 
-def _safe_api_invocation(req, msg, *args, **kwargs):
+class PownySession:
+    """
+    Shared keep-alive HTTP session for all Powny API calls.
+    Pool size, timeout and retry policy are taken from the `powny_api` settings section.
+    The session is created once and used by all threads, growing the pool replaces only its adapter.
+    """
+
+    defaults = {'pool_size': 10, 'timeout': 10, 'delete_timeout': 30, 'max_retries': 3, 'backoff_factor': 0.5}
+    session = None
+    pool_size = None
+    _lock = threading.Lock()
+
+    @classmethod
+    def get_option(cls, name):
+        options = Settings.config.get('powny_api') or {}
+        return options.get(name, cls.defaults[name])
+
+    @classmethod
+    def _mount_adapter(cls, session, pool_size: int):
+        retry = Retry(total=cls.get_option('max_retries'),
+                      backoff_factor=cls.get_option('backoff_factor'),
+                      status_forcelist=(502, 504),
+                      raise_on_status=False,
+                      **_RETRY_METHODS)
+        adapter = HTTPAdapter(pool_connections=pool_size,
+                              pool_maxsize=pool_size,
+                              max_retries=retry)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        cls.pool_size = pool_size
+
+    @classmethod
+    def reserve(cls, connections: int):
+        """Make sure the pool keeps at least `connections` connections alive, e.g. for parallel requests."""
+        with cls._lock:
+            if connections <= (cls.pool_size or cls.get_option('pool_size')):
+                return
+            if cls.session is None:
+                cls.pool_size = connections
+            else:
+                # Requests in progress finish with the old adapter, it isn't closed under them
+                cls._mount_adapter(cls.session, connections)
+
+    @classmethod
+    def get_session(cls):
+        if cls.session is None:
+            with cls._lock:
+                if cls.session is None:
+                    session = requests.Session()
+                    cls._mount_adapter(session, max(cls.pool_size or 0, cls.get_option('pool_size')))
+                    cls.session = session
+        return cls.session
+
+    @classmethod
+    def request(cls, method, url, **kwargs):
+        kwargs.setdefault('timeout', cls.get_option('timeout'))
+        return cls.get_session().request(method, url, **kwargs)
+
+    @classmethod
+    def get(cls, url, **kwargs):
+        return cls.request('GET', url, **kwargs)
+
+    @classmethod
+    def post(cls, url, **kwargs):
+        return cls.request('POST', url, **kwargs)
+
+    @classmethod
+    def delete(cls, url, **kwargs):
+        return cls.request('DELETE', url, **kwargs)
+
+    @classmethod
+    def close(cls):
+        with cls._lock:
+            if cls.session is not None:
+                cls.session.close()
+                cls.session = None
+            cls.pool_size = None
+
+
+def _safe_request(req, msg, *args, **kwargs):
     try:
         resp = req(*args, **kwargs)
-    except requests.ConnectionError:
+    except (requests.ConnectionError, requests.Timeout):
         raise PownyAPIException("Connection error while execute request: {}".format(*args, **kwargs))
     else:
         try:
@@ -26,17 +119,21 @@ def _safe_api_invocation(req, msg, *args, **kwargs):
             logger.error("Something goes wrong: {}".format(resp.content))
             raise PownyAPIException(msg)
         else:
-            return resp.json()['result']
+            return resp
+
+
+def _safe_api_invocation(req, msg, *args, **kwargs):
+    return _safe_request(req, msg, *args, **kwargs).json()['result']
 
 
 def get_cluster_info(powny_server: str):
-    return _safe_api_invocation(requests.get, "Can't get cluster info",
+    return _safe_api_invocation(PownySession.get, "Can't get cluster info",
                                 powny_server + '/v1/system/state')
 
 
 def send_event(powny_server: str, event_desc: dict):
     logger.info("Try to send event %s", event_desc)
-    jobs = _safe_api_invocation(requests.post, "Can't post new event.",
+    jobs = _safe_api_invocation(PownySession.post, "Can't post new event.",
                                 powny_server + '/v1/jobs',
                                 headers={'content-type': 'application/json'},
                                 data=json.dumps(event_desc))
@@ -46,19 +143,48 @@ def send_event(powny_server: str, event_desc: dict):
         logger.info("New event posted. Relevant jobs:")
         for (job_id, job_info) in jobs.items():
             logger.info("Job: %s -> %s", job_id, job_info['method'])
+    return jobs
 
 
-def terminate_job(powny_server: str, job_id: str):
-    logger.info("Try to kill job %s", job_id)
+def get_job_info(powny_server: str, job_id: str):
+    """Returns job's state or None if there is no such job, e.g. it is finished and removed"""
+    url = powny_server + '/v1/jobs/{}'.format(job_id)
+    try:
+        resp = PownySession.get(url)
+    except (requests.ConnectionError, requests.Timeout):
+        raise PownyAPIException("Connection error while execute request: {}".format(url))
+    if resp.status_code == 404:
+        return None
     try:
-        resp = requests.delete(powny_server + '/v1/jobs/{}'.format(job_id))
-    except requests.ConnectionError:
-        raise PownyAPIException("Connection error while execute request: {}".format(
-            powny_server + '/v1/jobs/{}'.format(job_id)))
+        resp.raise_for_status()
+    except requests.HTTPError:
+        raise PownyAPIException("Can't get job {} info".format(job_id), resp.text)
+    return resp.json()['result']
+
+
+def terminate_job(powny_server: str, job_id: str, retries=0, backoff_factor=0.5):
+    """
+    Delete the job, returns False if there is no such job.
+    Powny answers 503 if the job can't be deleted right now, such requests are retried up to `retries` times
+    after `backoff_factor * 2 ** attempt` seconds.
+    """
+    logger.info("Try to kill job %s", job_id)
+    url = powny_server + '/v1/jobs/{}'.format(job_id)
+    for attempt in range(retries + 1):
+        try:
+            resp = PownySession.delete(url, timeout=PownySession.get_option('delete_timeout'))
+        except requests.ReadTimeout:
+            raise PownyAPIException("Timeout while execute request: {}, the job may be still deleted".format(url))
+        except (requests.ConnectionError, requests.Timeout):
+            raise PownyAPIException("Connection error while execute request: {}".format(url))
+        if resp.status_code != 503 or attempt == retries:
+            break
+        logger.debug("Job %s can't be deleted now, retry in %.1f sec", job_id, backoff_factor * 2 ** attempt)
+        time.sleep(backoff_factor * 2 ** attempt)
 
     if resp.status_code == 404:
         logger.info("Job id `{}` is not found. Probably it is already deleted or was not created".format(job_id))
-        return
+        return False
     elif resp.status_code == 503:
         logger.error("Can't delete job with id `{}` in this time. Please try again now".format(job_id))
     try:
@@ -67,25 +193,174 @@ def terminate_job(powny_server: str, job_id: str):
         raise PownyAPIException("Can't delete job id {}".format(job_id), resp.text)
     else:
         logger.info("Job id {} was deleted".format(job_id))
+        return True
 
 
 def set_header(powny_server: str, head: str):
-    return _safe_api_invocation(requests.post, "Can't upload new HEAD.",
+    return _safe_api_invocation(PownySession.post, "Can't upload new HEAD.",
                                 powny_server + '/v1/rules',
                                 headers={'content-type': 'application/json'},
                                 data=json.dumps({'head': head}))
 
 
 def get_rules_info(powny_server: str):
-    return _safe_api_invocation(requests.get, "Can't get the rules info.",
+    return _safe_api_invocation(PownySession.get, "Can't get the rules info.",
                                 powny_server + '/v1/rules')
 
 
-def get_jobs(powny_server: str):
-    return _safe_api_invocation(requests.get, "Can't get jobs list",
-                                powny_server + '/v1/jobs')
+def iter_jobs(powny_server: str):
+    """
+    Yield `(job_id, job)` pairs of the jobs list while the response is being received,
+    the whole list is never kept in memory.
+    """
+    resp = _safe_request(PownySession.get, "Can't get jobs list", powny_server + '/v1/jobs', stream=True)
+    try:
+        yield from _iter_result_items(resp.iter_content(64 * 1024))
+    except ValueError as error:
+        raise PownyAPIException("Can't parse jobs list: {}".format(error))
+    finally:
+        resp.close()
+
+
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+_SPACES = ' \t\n\r'
+
+
+class _JsonReader:
+    """Incremental reader of a JSON document received by chunks of bytes"""
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._text_decoder = codecs.getincrementaldecoder('utf-8')()
+        self._json_decoder = json.JSONDecoder()
+        self._buffer = ''
+        self._pos = 0
+        self._eof = False
+
+    def _read(self):
+        if self._eof:
+            raise ValueError("Unexpected end of JSON document")
+        if self._pos > 64 * 1024:
+            self._buffer = self._buffer[self._pos:]
+            self._pos = 0
+        chunk = next(self._chunks, None)
+        if chunk is None:
+            self._eof = True
+            self._buffer += self._text_decoder.decode(b'', final=True)
+        else:
+            self._buffer += self._text_decoder.decode(chunk)
+
+    def peek(self):
+        """The next char after whitespace, it is not consumed"""
+        while True:
+            self._pos = _WHITESPACE.match(self._buffer, self._pos).end()
+            if self._pos < len(self._buffer):
+                return self._buffer[self._pos]
+            self._read()
+
+    def expect(self, chars: str):
+        char = self.peek()
+        if char not in chars:
+            raise ValueError("Expected {!r} instead of {!r}".format(chars, char))
+        self._pos += 1
+        return char
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                (value, end) = self._json_decoder.raw_decode(self._buffer, self._pos)
+            except ValueError:
+                if self._eof:
+                    raise
+                self._read()
+                continue
+            if end == len(self._buffer) and not self._eof:
+                self._read()  # A number can be continued in the next chunk
+                continue
+            self._pos = end
+            return value
+
+    def iter_keys(self):
+        """Keys of the object at the current position, the value of each key must be read by the caller"""
+        self.expect('{')
+        if self.peek() == '}':
+            self._pos += 1
+            return
+        while True:
+            key = self.value()
+            self.expect(':')
+            yield key
+            if self.expect(',}') == '}':
+                return
+
+    def iter_items(self):
+        """
+        `(key, value)` pairs of the object at the current position.
+        The same as `iter_keys()` with `value()`, but without method calls per token, it is the hot loop.
+        """
+        self.expect('{')
+        if self.peek() == '}':
+            self._pos += 1
+            return
+        scan_once = self._json_decoder.scan_once
+        while True:
+            (buffer, pos) = (self._buffer, self._pos)
+            try:
+                while buffer[pos] in _SPACES:
+                    pos += 1
+                (key, pos) = scan_once(buffer, pos)
+                while buffer[pos] in _SPACES:
+                    pos += 1
+                if buffer[pos] != ':' or not isinstance(key, str):
+                    raise ValueError("Invalid key")
+                pos += 1
+                while buffer[pos] in _SPACES:
+                    pos += 1
+                (value, pos) = scan_once(buffer, pos)
+                while buffer[pos] in _SPACES:
+                    pos += 1
+                separator = buffer[pos]  # Also a number can be continued in the next chunk if there is no one
+                if separator not in ',}':
+                    raise ValueError("Invalid separator")
+            except (IndexError, StopIteration, ValueError):
+                # The pair is not received completely, invalid documents end up with an error of `_read()`
+                self._read()
+                continue
+            self._pos = pos + 1
+            yield key, value
+            if separator == '}':
+                return
+
+
+def _iter_result_items(chunks):
+    """`(key, value)` pairs of the `result` object of Powny API response, values are decoded one by one"""
+    reader = _JsonReader(chunks)
+    for key in reader.iter_keys():
+        if key == 'result':
+            for item in reader.iter_items():
+                yield item
+        else:
+            reader.value()
 
 
 def get_cluster_config(powny_server: str):
-    return _safe_api_invocation(requests.get, "Can't get powny's cluster config from server",
+    return _safe_api_invocation(PownySession.get, "Can't get powny's cluster config from server",
                                 powny_server + '/v1/system/config')
+
+
+def revalidate_cluster_config(powny_server: str, etag=None, last_modified=None):
+    """
+    Conditional GET of the cluster config.
+    Returns `(config, etag, last_modified)`, `config` is None if it was not modified since the given validators.
+    """
+    headers = {}
+    if etag:
+        headers['If-None-Match'] = etag
+    if last_modified:
+        headers['If-Modified-Since'] = last_modified
+    resp = _safe_request(PownySession.get, "Can't get powny's cluster config from server",
+                         powny_server + '/v1/system/config', headers=headers)
+    if resp.status_code == 304:
+        return None, etag, last_modified
+    return resp.json()['result'], resp.headers.get('ETag'), resp.headers.get('Last-Modified')
@@ -0,0 +1,220 @@
+"""
+This module replays timestamped events at their original pace, slower or faster.
+Events are passed to a `send(event)` function, e.g. posted to Powny API or executed by the local rules.
+"""
+
+import time
+import random
+import logging
+import threading
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+
+logger = logging.getLogger(__name__)
+
+TIME_FORMATS = ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d %H:%M:%S.%f', '%Y-%m-%d %H:%M:%S')
+_EPOCH = datetime(1970, 1, 1)
+
+
+class ReplayError(Exception):
+    pass
+
+
+def parse_time(value):
+    """UNIX time or ISO 8601 time in UTC (with or without `Z`) to seconds"""
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return float(value)
+    if isinstance(value, str):
+        text = value[:-1] if value.endswith('Z') else value
+        for time_format in TIME_FORMATS:
+            try:
+                return (datetime.strptime(text, time_format) - _EPOCH).total_seconds()
+            except ValueError:
+                continue
+    raise ReplayError("Unknown time format: {!r}".format(value))
+
+
+class TokenBucket:
+    """
+    Rate limiter: `rate` tokens per second are added to the bucket up to `burst` tokens,
+    every call takes one token and waits for it if the bucket is empty.
+    """
+
+    def __init__(self, rate: float, burst=1, clock=time.monotonic, sleep=time.sleep):
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self.sleep = sleep
+        self.tokens = burst
+        self.updated = clock()
+
+    def acquire(self):
+        now = self.clock()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1:
+            self.sleep((1 - self.tokens) / self.rate)
+            self.tokens = 1
+            self.updated = self.clock()
+        self.tokens -= 1
+
+
+class Reservoir:
+    """
+    Uniform random sample of at most `size` values out of all added ones (reservoir sampling),
+    so percentiles of a long replay are estimated in constant memory.
+    """
+
+    def __init__(self, size=10000, rand=None):
+        self.size = size
+        self.rand = rand or random.Random()
+        self.count = 0
+        self.samples = []
+
+    def add(self, value):
+        self.count += 1
+        if len(self.samples) < self.size:
+            self.samples.append(value)
+            return
+        position = self.rand.randrange(self.count)
+        if position < self.size:
+            self.samples[position] = value
+
+    def get_percentiles(self, shares):
+        """Nearest rank percentiles of the sample, None if it is empty"""
+        samples = sorted(self.samples)
+        if not samples:
+            return [None for _ in shares]
+        return [samples[min(len(samples) - 1, int(len(samples) * share))] for share in shares]
+
+
+class ReplayStats:
+    """Thread safe counters of all replayed events and of the current reporting period"""
+
+    def __init__(self, clock=time.monotonic, sample_size=10000):
+        self.clock = clock
+        self.sample_size = sample_size
+        self.started = self.period_started = clock()
+        self.errors = 0
+        self.latencies = Reservoir(sample_size)
+        self.period_latencies = Reservoir(sample_size)
+        self.period_errors = 0
+        self.lag = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, latency: float, failed: bool):
+        with self._lock:
+            self.latencies.add(latency)
+            self.period_latencies.add(latency)
+            if failed:
+                self.errors += 1
+                self.period_errors += 1
+
+    def _summary(self, latencies: Reservoir, errors: int, elapsed: float):
+        summary = {'events': latencies.count, 'errors': errors,
+                   'rate': latencies.count / elapsed if elapsed > 0 else 0.0, 'lag': self.lag}
+        summary.update(zip(('p50', 'p95', 'p99'), latencies.get_percentiles((0.5, 0.95, 0.99))))
+        return summary
+
+    def get_period(self):
+        """Summary since the previous call, the period is started again"""
+        with self._lock:
+            now = self.clock()
+            summary = self._summary(self.period_latencies, self.period_errors, now - self.period_started)
+            self.period_started = now
+            self.period_latencies = Reservoir(self.sample_size)
+            self.period_errors = 0
+        return summary
+
+    def get_total(self):
+        with self._lock:
+            return self._summary(self.latencies, self.errors, self.clock() - self.started)
+
+
+def _format_summary(summary: dict):
+    line = "{events} events, {errors} errors, {rate:.1f} events/sec".format(**summary)
+    if summary['p50'] is not None:
+        line += ", latency p50 {:.3f} p95 {:.3f} p99 {:.3f} sec".format(summary['p50'], summary['p95'],
+                                                                        summary['p99'])
+    if summary['lag'] >= 0.01:
+        line += ", max lag behind the schedule {:.2f} sec".format(summary['lag'])
+    return line
+
+
+def _timed(send, clock, event):
+    """Thread pool task: `(latency, error or None)` of one event"""
+    started = clock()
+    try:
+        send(event)
+    except Exception as error:
+        return clock() - started, error
+    return clock() - started, None
+
+
+def _iter_scheduled(events, time_field: str, speed: float, bucket, slots, stats: ReplayStats, clock, sleep):
+    """
+    Yield events when they are due: at the same intervals as their times divided by `speed` (`0` ignores them),
+    but not faster than `bucket` allows. Events without time or earlier than the previous one are due at once.
+    A slot of `slots` semaphore is taken for each event before waiting for it, so busy slots delay the schedule.
+    """
+    first_time = started = None
+    offset = 0.0
+    for event in events:
+        slots.acquire()
+        if speed and event.get(time_field) is not None:
+            event_time = parse_time(event[time_field])
+            if first_time is None:
+                first_time, started = event_time, clock()
+            offset = max(offset, (event_time - first_time) / speed)
+            delay = started + offset - clock()
+            if delay > 0:
+                sleep(delay)
+            else:
+                stats.lag = max(stats.lag, -delay)
+        if bucket is not None:
+            bucket.acquire()
+        yield event
+
+
+def _report_periodically(stats: ReplayStats, interval: float, stopped: threading.Event):
+    """Reporter thread: log stats of each period, including the periods without events"""
+    while not stopped.wait(interval):
+        logger.info("Replayed %s", _format_summary(stats.get_period()))
+
+
+def replay(events, send, time_field='timestamp', speed=1.0, rate=None, burst=1, concurrency=1,
+           stats_interval=5.0, clock=time.monotonic, sleep=time.sleep):
+    """
+    Pass `events` to `send(event)` at the pace of their `time_field` multiplied by `speed`,
+    with at most `rate` events per second (`burst` of them at once) and `concurrency` calls in flight.
+    An exception of `send` is counted and logged as an error as soon as the call ends.
+    Stats of the period are logged every `stats_interval` sec.
+    If calls can't keep up with the schedule, the next events are delayed and the lag is reported.
+    Returns the total stats.
+    """
+    stats = ReplayStats(clock)
+    bucket = TokenBucket(rate, burst, clock, sleep) if rate else None
+    slots = threading.BoundedSemaphore(concurrency)
+
+    def on_done(event, future):
+        latency, error = future.result()
+        slots.release()
+        if error is not None:
+            logger.error("Can't replay event %s: %s", event, error)
+        stats.add(latency, error is not None)
+
+    stopped = threading.Event()
+    reporter = threading.Thread(target=_report_periodically, args=(stats, stats_interval, stopped))
+    reporter.daemon = True
+    reporter.start()
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            for event in _iter_scheduled(events, time_field, speed, bucket, slots, stats, clock, sleep):
+                executor.submit(_timed, send, clock, event).add_done_callback(partial(on_done, event))
+    finally:
+        stopped.set()
+    total = stats.get_total()
+    logger.info("Total: %s", _format_summary(total))
+    return total
@@ -0,0 +1,121 @@
+"""
+This module caches compiled bytecode of the rules by git blob hashes.
+
+Checkouts, pulls and rebases touch the rule files, so Python's own `__pycache__` (validated by mtime)
+is often stale and every local run re-parses the whole rules repository.
+Here the bytecode is stored in `~/.config/powny-cli/cache/bytecode/` under the blob hash of the source,
+so unchanged modules are never compiled again; for files clean in git the source is not even read.
+"""
+
+import os
+import sys
+import marshal
+import hashlib
+import logging
+import contextlib
+import importlib.util
+from importlib.abc import MetaPathFinder
+from importlib.machinery import PathFinder, SourceFileLoader
+from pownycli import cache
+from pownycli import gitapi
+
+logger = logging.getLogger(__name__)
+
+
+def get_bytecode_dir():
+    return os.path.join(cache.get_cache_dir(), 'bytecode')
+
+
+def _blob_hash(data: bytes):
+    """The same hash as `git hash-object` computes"""
+    return hashlib.sha1(b'blob ' + str(len(data)).encode() + b'\0' + data).hexdigest()
+
+
+class _CachingLoader(SourceFileLoader):
+    def __init__(self, fullname, path, blob):
+        super().__init__(fullname, path)
+        self.blob = blob
+
+    def _get_cache_path(self, blob):
+        # The path is a part of the key, since it is stored in the code object (e.g. for tracebacks)
+        key = '{}:{}:'.format(blob, self.path).encode() + importlib.util.MAGIC_NUMBER
+        return os.path.join(get_bytecode_dir(), hashlib.sha1(key).hexdigest())
+
+    def get_code(self, fullname):
+        source = None
+        blob = self.blob
+        if blob is None:
+            source = self.get_data(self.path)
+            blob = _blob_hash(source)
+
+        cache_path = self._get_cache_path(blob)
+        try:
+            with open(cache_path, 'rb') as cache_file:
+                return marshal.load(cache_file)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, EOFError, TypeError) as error:
+            logger.debug("Broken bytecode cache %s: %s", cache_path, error)
+
+        if source is None:
+            source = self.get_data(self.path)
+        code = self.source_to_code(source, self.path)
+        logger.debug("Compiled %s", self.path)
+        try:
+            os.makedirs(get_bytecode_dir(), exist_ok=True)
+            tmp_path = '{}.{}.tmp'.format(cache_path, os.getpid())
+            with open(tmp_path, 'wb') as cache_file:
+                marshal.dump(code, cache_file)
+            os.replace(tmp_path, cache_path)
+        except OSError as error:
+            logger.debug("Can't write bytecode cache %s: %s", cache_path, error)
+        return code
+
+
+class _RulesFinder(MetaPathFinder):
+    def __init__(self, rules_path, blobs):
+        self.rules_path = os.path.abspath(rules_path) + os.sep
+        self.blobs = blobs
+
+    def find_spec(self, fullname, path, target=None):
+        spec = PathFinder.find_spec(fullname, path, target)
+        if spec is None or not isinstance(spec.loader, SourceFileLoader):
+            return None
+        if not spec.origin or not spec.origin.startswith(self.rules_path):
+            return None
+        spec.loader = _CachingLoader(fullname, spec.origin, self.blobs.get(spec.origin))
+        return spec
+
+
+@contextlib.contextmanager
+def bytecode_cache(rules_path: str):
+    """Within this context the modules from `rules_path` are imported through the bytecode cache"""
+    try:
+        blobs = gitapi.get_blob_hashes(rules_path)
+    except gitapi.GitCommandError:
+        logger.debug("%s is not a git repository, rule files will be hashed", rules_path)
+        blobs = {}
+
+    finder = _RulesFinder(rules_path, blobs)
+    position = sys.meta_path.index(PathFinder) if PathFinder in sys.meta_path else len(sys.meta_path)
+    sys.meta_path.insert(position, finder)
+    try:
+        yield
+    finally:
+        sys.meta_path.remove(finder)
+
+
+def iter_entries():
+    bytecode_dir = get_bytecode_dir()
+    if not os.path.isdir(bytecode_dir):
+        return
+    for name in os.listdir(bytecode_dir):
+        yield os.path.join(bytecode_dir, name)
+
+
+def purge():
+    removed = 0
+    for path in list(iter_entries()):
+        os.remove(path)
+        removed += 1
+    return removed
@@ -1,7 +1,5 @@
 import os
-import yaml
 import logging
-from pkg_resources import resource_stream
 
 logger = logging.getLogger(__name__)
 
@@ -20,6 +18,10 @@ class Settings:
         else:
             raise RuntimeError("powny-cli misconfigured.")
 
+    @staticmethod
+    def get_default_config_path():
+        return os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config.yaml')
+
     @staticmethod
     def merge(config, update, paths=None):
         if paths is None:
@@ -36,12 +38,14 @@ class Settings:
     def load(cls, ctx, param, file):
         """This callback loads config from file, if option `--config/-c` is defined,
            in any other cases loads config by default paths"""
+        import yaml
         if file:
             logger.debug("Load config from %s", file)
             added_config = yaml.load(file) or {}
             cls.merge(cls.config, added_config)
         else:
-            cls.merge(cls.config, yaml.load(resource_stream(__name__, 'config.yaml')))
+            with open(cls.get_default_config_path()) as default_config:
+                cls.merge(cls.config, yaml.load(default_config))
             logger.debug("Load default config")
             path_to_user_config = os.path.expanduser('~/.config/powny-cli/config.yaml')
             if os.path.exists(path_to_user_config):
@@ -1,10 +1,15 @@
 from colorama import Fore, Style
-from itertools import cycle
+from itertools import cycle, zip_longest
+from tabloid import FormattedTable
+from collections import deque, namedtuple
+from concurrent.futures import wait
 
 
 class Colorfull:
     nodes = {}
+    levels = {}
     colors = cycle((Fore.BLUE, Fore.MAGENTA, Fore.CYAN))
+    level_colors = {'DEBUG': Fore.WHITE, 'INFO': Fore.GREEN}
 
     @classmethod
     def get_node(cls, node, _):
@@ -16,9 +21,114 @@ class Colorfull:
 
     @classmethod
     def get_level(cls, level, _):
-        return {'DEBUG': '{}{}{}'.format(Fore.WHITE, level, Style.RESET_ALL),
-                'INFO': '{}{}{}'.format(Fore.GREEN, level, Style.RESET_ALL)}.get(level.strip(), level)
+        if level not in cls.levels:
+            color = cls.level_colors.get(level.strip())
+            cls.levels[level] = level if color is None else '{}{}{}'.format(color, level, Style.RESET_ALL)
+        return cls.levels[level]
 
     @classmethod
     def timestamp(cls, timestamp, _):
         return '{}{}{}'.format(Fore.YELLOW, timestamp, Style.RESET_ALL)
+
+
+class StreamingTable(FormattedTable):
+    """
+    `tabloid.FormattedTable` printed page by page, rows are not kept in memory.
+    Column widths are fixed by `add_column(width=...)` or sampled from the first `sample_size` rows,
+    wider values of later rows are wrapped.
+    """
+
+    def __init__(self, *args, sample_size=100, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._sample_size = sample_size
+        self._layout = None
+
+    def add_column(self, name, formatter=None, max_width=None, width=None):
+        super().add_column(name, formatter, max_width)
+        if width is not None:
+            self._table[-1]['width'] = max(width, len(name))
+            self._table[-1]['fixed'] = True
+
+    def _sample(self, rows):
+        for row in rows[:self._sample_size]:
+            for (column, value) in zip(self._table, row):
+                if column.get('fixed'):
+                    continue
+                width = len(value) if column['max_width'] is None else min(len(value), column['max_width'])
+                column['width'] = max(column['width'], width)
+
+    def _format_line(self, values, row):
+        line = ''
+        for ((_, width, formatter), value) in zip(self._layout, values):
+            cell = self._indent + value + self._fill_symbol * (width - self._padding - len(value))
+            line += cell if formatter is None else formatter(cell, row)
+        return line
+
+    def _format_row(self, row):
+        """The same lines as tabloid makes, but with the layout computed once per table"""
+        if all(len(value) < width for ((_, width, _), value) in zip(self._layout, row)):
+            return [self._format_line(row, row)]
+        sliced = []
+        for ((column_width, width, _), value) in zip(self._layout, row):
+            if len(value) < width:
+                sliced.append([value])
+            else:
+                sliced.append([value[start:start + column_width] for start in range(0, len(value), column_width)])
+        return [self._format_line(values, row) for values in zip_longest(*sliced, fillvalue=self._fill_symbol)]
+
+    def iter_page(self, rows):
+        """Yield formatted lines of the rows, the first page is preceded by the header"""
+        rows = [[str(value) for value in row] for row in rows]
+        if not rows:
+            return
+        if self._layout is None:
+            self._sample(rows)
+            header = self._align_head()
+            self._indent = self._fill_symbol * self._padding
+            self._layout = [(column['width'], column['width'] + self._padding, column['formatter'])
+                            for column in self._table]
+            yield '{}{}{}'.format(self._header_background, header, Style.RESET_ALL)
+        for row in rows:
+            for line in self._format_row(row):
+                yield line
+
+
+def bounded_map(executor, func, items, limit: int):
+    """
+    Submit `func(item)` to `executor` for each item, keeping at most `limit` calls in flight.
+    Items are consumed lazily. Yields `(item, future)` pairs in the input order, futures are done.
+    """
+    pending = deque()
+    for item in items:
+        pending.append((item, executor.submit(func, item)))
+        if len(pending) >= limit:
+            item, future = pending.popleft()
+            wait((future,))
+            yield item, future
+    while pending:
+        item, future = pending.popleft()
+        wait((future,))
+        yield item, future
+
+
+Change = namedtuple('Change', ('op', 'path', 'old', 'new'))
+
+
+def diff_structures(old, new, ignore=(), path=()):
+    """
+    Yield `Change`s turning `old` into `new`. Dicts are compared key by key recursively, other values
+    (lists too) as a whole. `op` is `add`, `remove` or `change`, `path` is the tuple of keys to the value.
+    Keys listed in `ignore` are skipped at any depth, e.g. timestamps of heartbeats.
+    """
+    if isinstance(old, dict) and isinstance(new, dict):
+        for key in sorted(set(old) | set(new), key=str):
+            if key in ignore:
+                continue
+            if key not in new:
+                yield Change('remove', path + (key,), old[key], None)
+            elif key not in old:
+                yield Change('add', path + (key,), None, new[key])
+            else:
+                yield from diff_structures(old[key], new[key], ignore, path + (key,))
+    elif old != new:
+        yield Change('change', path, old, new)
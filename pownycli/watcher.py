@@ -0,0 +1,96 @@
+"""
+This module watches the rules directory for changed python files.
+It uses inotify if `inotify_simple` is installed and polls the directory otherwise.
+"""
+
+import os
+import time
+import logging
+
+try:
+    import inotify_simple
+except ImportError:
+    inotify_simple = None
+
+logger = logging.getLogger(__name__)
+
+_SKIP_DIRS = ('.git', '__pycache__')
+
+
+def _iter_dirs(root: str):
+    for (dir_path, dirs, _) in os.walk(root):
+        dirs[:] = [name for name in dirs if name not in _SKIP_DIRS]
+        yield dir_path
+
+
+def snapshot(root: str):
+    """`{path: (mtime, size)}` of python files under `root`"""
+    files = {}
+    for dir_path in _iter_dirs(root):
+        for name in os.listdir(dir_path):
+            if name.endswith('.py'):
+                path = os.path.join(dir_path, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                files[path] = (stat.st_mtime_ns, stat.st_size)
+    return files
+
+
+def get_changed(old: dict, new: dict):
+    """Files created, changed or removed between two snapshots"""
+    return set(path for path in set(old) | set(new) if old.get(path) != new.get(path))
+
+
+class _PollingWaiter:
+    def __init__(self, root: str, interval: float):
+        self.interval = interval
+
+    def __call__(self):
+        time.sleep(self.interval)
+
+
+class _InotifyWaiter:
+    def __init__(self, root: str, interval: float):
+        flags = inotify_simple.flags
+        self.mask = (flags.CLOSE_WRITE | flags.CREATE | flags.DELETE | flags.MOVED_FROM |
+                     flags.MOVED_TO | flags.MODIFY)
+        self.root = root
+        self.delay = int(interval * 1000)
+        self.inotify = inotify_simple.INotify()
+        self._add_watches()
+
+    def _add_watches(self):
+        # Watches are per directory, so new subdirectories are added after each wakeup
+        for dir_path in _iter_dirs(self.root):
+            try:
+                self.inotify.add_watch(dir_path, self.mask)
+            except OSError as error:
+                logger.debug("Can't watch %s: %s", dir_path, error)
+
+    def __call__(self):
+        self.inotify.read(read_delay=self.delay)
+        self._add_watches()
+
+
+def iter_changes(root: str, interval=0.5):
+    """
+    Yield sets of python files under `root` created, changed or removed since the previous step.
+    Blocks until there are changes.
+    """
+    if inotify_simple is not None:
+        logger.debug("Watch %s with inotify", root)
+        wait = _InotifyWaiter(root, interval / 10)
+    else:
+        logger.debug("Poll %s every %s sec", root, interval)
+        wait = _PollingWaiter(root, interval)
+
+    previous = snapshot(root)
+    while True:
+        wait()
+        current = snapshot(root)
+        changed = get_changed(previous, current)
+        previous = current
+        if changed:
+            yield changed
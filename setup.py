@@ -2,9 +2,17 @@
 
 from setuptools import setup
 from setuptools.command.test import test as TestCommand
+import os
+import re
 import sys
 
 
+def get_version():
+    # `pownycli/__init__.py` is the only place of the version, `powny --version` doesn't scan installed packages
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pownycli', '__init__.py')) as init_file:
+        return re.search(r"^__version__ = '([^']+)'", init_file.read(), re.M).group(1)
+
+
 class PyTest(TestCommand):
     user_options = [('pytest-args=', 'a', "Arguments to pass to py.test")]
 
@@ -26,7 +34,7 @@ class PyTest(TestCommand):
 
 if __name__ == '__main__':
     setup(name='powny-cli',
-          version='0.9.3',
+          version=get_version(),
           description='Powny command line tool',
           author='Alexander Kushnarev',
           author_email='avkushnarev@gmail.com',
@@ -34,7 +42,8 @@ if __name__ == '__main__':
           packages=['pownycli'],
           package_data={'pownycli': ['config.yaml']},
           entry_points={'console_scripts': ['powny = pownycli.client:main']},
-          install_requires=['powny>=1.0.0', 'pyyaml', 'click>=2', 'envoy-beta', 'requests',
+          install_requires=['powny>=1.0.0', 'pyyaml', 'click>=2', 'requests',
                             'colorlog', 'colorama', 'tabloid'],
+          extras_require={'watch': ['inotify_simple']},
           tests_require=['vcrpy', 'pytest-cov'],
           cmdclass={'test': PyTest})
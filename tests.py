@@ -1,7 +1,22 @@
+import io
+import os
+import json
+import itertools
+import sys
+import tempfile
+import time
+import subprocess
+import threading
 import unittest
 import vcr
+import tabloid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from unittest import mock
 from click.testing import CliRunner
-from pownycli import client, settings
+from pownycli import (client, settings, pownyapi, util, events, matchindex, cache, rulecache, watcher, cas,
+                      elasticapi, gitapi, gitrepo, checker, replay)
+from powny.core.backends import CasNoValueError, CasVersionError
 
 
 test_vcr = vcr.VCR(cassette_library_dir="fixtures")
@@ -41,3 +56,807 @@ class TestPownyCommand(unittest.TestCase):
             self.assertEqual(cass.requests[0].uri,
                              self.api_url + "/v1/jobs")
             self.assertEqual(result.exit_code, 0)
+
+
+class TestWorkDir(unittest.TestCase):
+    def test_missing(self):
+        settings.Settings.config = {'rules-path': '/nonexistent/rules'}
+        with self.assertRaises(client.click.BadParameter) as error:
+            client._check_rules_repo()
+        self.assertEqual(error.exception.param_hint, "'--work-dir'")
+
+
+class TestClusterWatch(unittest.TestCase):
+    def setUp(self):
+        settings.Settings.config = {'powny_api_url': "http://localhost"}
+        self.states = [
+            {'apps': {'node1': {'when': 1, 'processed': 1}}, 'jobs': {'all': 7}},
+            {'apps': {'node1': {'when': 2, 'processed': 1}}, 'jobs': {'all': 7}},
+            {'apps': {'node1': {'when': 3, 'processed': 2}, 'node2': {'when': 3}}, 'jobs': {'all': 8}},
+        ]
+
+    def test_diff_structures(self):
+        old = {'a': {'b': 1, 'c': [1]}, 'd': 1, 'when': 1}
+        new = {'a': {'b': 2, 'c': [1], 'e': None}, 'when': 2}
+        self.assertEqual(list(util.diff_structures(old, new, ignore=('when',))), [
+            util.Change('change', ('a', 'b'), 1, 2),
+            util.Change('add', ('a', 'e'), None, None),
+            util.Change('remove', ('d',), 1, None),
+        ])
+        self.assertEqual(list(util.diff_structures([1], [1, 2])), [util.Change('change', (), [1], [1, 2])])
+
+    def _watch(self, *args):
+        responses = [self.states[0], self.states[1], pownyapi.PownyAPIException("Unavailable"), self.states[2],
+                     KeyboardInterrupt]
+        with mock.patch.object(pownyapi, 'get_cluster_info', side_effect=responses), \
+                mock.patch.object(client.time, 'sleep'):
+            return CliRunner().invoke(client.cluster_info, ['--watch', '--ignore', 'when'] + list(args))
+
+    def test_sections(self):
+        output = self._watch().output
+        # Nothing but ignored keys changed in the second state
+        self.assertEqual(output.count('--- '), 1)
+        self.assertIn("3 changes\napps.node1:\n  processed: 2\n  when: 3\napps.node2:\n  when: 3\njobs.all: 8\n",
+                      output)
+
+    def test_json_lines(self):
+        lines = [json.loads(line) for line in self._watch('--json-lines').output.splitlines()
+                 if line.startswith('{')]
+        self.assertEqual(lines[0]['op'], 'snapshot')
+        self.assertEqual([(line['op'], line['path'], line['new']) for line in lines[1:]], [
+            ('change', ['apps', 'node1', 'processed'], 2),
+            ('add', ['apps', 'node2'], {'when': 3}),
+            ('change', ['jobs', 'all'], 8),
+        ])
+
+
+class TestJobKill(unittest.TestCase):
+    def setUp(self):
+        settings.Settings.config = {'powny_api_url': 'http://localhost'}
+        self.jobs = {
+            'job-1': {'method': 'rules.foo.on_event', 'created': '2015-01-01 00:00:00.000000Z'},
+            'job-2': {'method': 'rules.bar.on_event', 'created': '2015-01-01 00:00:00.000000Z'},
+            'job-3': {'method': 'rules.foo.on_event', 'created': datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S.%fZ')},
+        }
+
+    @staticmethod
+    def _response(status):
+        resp = mock.Mock(status_code=status)
+        resp.raise_for_status.side_effect = None if status < 400 else pownyapi.requests.HTTPError()
+        return resp
+
+    def test_retry(self):
+        statuses = {'job-1': [503, 503, 200], 'job-2': [404], 'job-3': [503] * 10}
+
+        def delete(url, **kwargs):
+            return self._response(statuses[url.rsplit('/', 1)[1]].pop(0))
+
+        with mock.patch.object(pownyapi.PownySession, 'delete', side_effect=delete), \
+                mock.patch.object(pownyapi.time, 'sleep') as sleep:
+            result = CliRunner().invoke(client.job, ['kill', 'job-1', '--from-file', '-', '--retries', '2'],
+                                        input='job-2 rules.bar.on_event\njob-3\n')
+        self.assertEqual(result.exit_code, 1)
+        self.assertEqual(str(result.exception), "1 of 3 jobs were not killed")
+        self.assertEqual((statuses['job-1'], len(statuses['job-3'])), ([], 7))
+        self.assertEqual(sleep.call_count, 4)
+
+    def test_filters(self):
+        with mock.patch.object(pownyapi, 'iter_jobs', return_value=iter(dict.fromkeys(self.jobs).items())), \
+                mock.patch.object(pownyapi, 'get_job_info', side_effect=lambda _, job_id: self.jobs[job_id]):
+            result = CliRunner().invoke(client.job, ['kill', '--method', 'rules.foo.*', '--older-than', '1h',
+                                                     '--dry-run'])
+        self.assertEqual(result.output.split(), ['job-1'])
+
+
+class TestJobList(unittest.TestCase):
+    def setUp(self):
+        settings.Settings.config = {'powny_api_url': 'http://localhost'}
+        self.jobs = {'job-{}'.format(number): {'method': 'rules.on_event_{}'.format(number % 3),
+                                               'created': '2015-01-01 00:00:00.000000Z',
+                                               'taken': number % 2 == 0, 'finished': None}
+                     for number in range(10)}
+
+    def test_streaming_parse(self):
+        body = json.dumps({'status': 'ok', 'message': 'The list with all jobs', 'result': self.jobs}).encode()
+        for size in (1, 7, len(body)):
+            chunks = [body[offset:offset + size] for offset in range(0, len(body), size)]
+            self.assertEqual(dict(pownyapi._iter_result_items(chunks)), self.jobs)
+        with self.assertRaises(ValueError):
+            list(pownyapi._iter_result_items([body[:-10]]))
+
+    def test_group_by(self):
+        with mock.patch.object(pownyapi, 'iter_jobs', side_effect=lambda _: iter(dict.fromkeys(self.jobs).items())), \
+                mock.patch.object(pownyapi, 'get_job_info', side_effect=lambda _, job_id: self.jobs[job_id]):
+            result = CliRunner().invoke(client.job, ['list', '--state', 'taken', '--group-by', 'method', '--top', '2'])
+            self.assertEqual([line.split() for line in result.output.splitlines()],
+                             [['2', 'rules.on_event_0'], ['2', 'rules.on_event_2']])
+            result = CliRunner().invoke(client.job, ['list', '--format', 'json', '--method', '*_1'])
+            self.assertEqual([json.loads(line)['id'] for line in result.output.splitlines()],
+                             sorted(job_id for job_id in self.jobs if job_id[-1] in '147'))
+
+    def test_top_without_group_by(self):
+        with mock.patch.object(pownyapi, 'iter_jobs') as iter_jobs:
+            result = CliRunner().invoke(client.job, ['list', '--top', '2'])
+        self.assertEqual(result.exit_code, 2)
+        self.assertIn('--group-by', result.output)
+        self.assertFalse(iter_jobs.called)
+
+
+class TestPownySession(unittest.TestCase):
+    def setUp(self):
+        settings.Settings.config = {'powny_api': {'pool_size': 3, 'max_retries': 5}}
+
+    def tearDown(self):
+        pownyapi.PownySession.close()
+
+    def test_session_is_shared(self):
+        self.assertIs(pownyapi.PownySession.get_session(), pownyapi.PownySession.get_session())
+
+    def test_session_created_once(self):
+        with mock.patch.object(pownyapi.requests, 'Session', side_effect=lambda: time.sleep(0.01) or mock.Mock()):
+            with ThreadPoolExecutor(max_workers=8) as executor:
+                sessions = list(executor.map(lambda _: pownyapi.PownySession.get_session(), range(8)))
+        self.assertEqual(len(set(map(id, sessions))), 1)
+
+    def test_reserve_keeps_session(self):
+        session = pownyapi.PownySession.get_session()
+        pownyapi.PownySession.reserve(20)
+        self.assertIs(pownyapi.PownySession.get_session(), session)
+        self.assertEqual(session.get_adapter("http://localhost")._pool_maxsize, 20)
+
+    def test_delete_is_not_resent(self):
+        retry = pownyapi.PownySession.get_session().get_adapter("http://localhost").max_retries
+        self.assertFalse(retry._is_method_retryable('DELETE'))
+        self.assertTrue(retry._is_method_retryable('GET'))
+        with mock.patch.object(pownyapi.PownySession, 'request') as request:
+            request.return_value.status_code = 200
+            pownyapi.terminate_job("http://localhost", "job")
+        self.assertEqual(request.call_args[1]['timeout'], pownyapi.PownySession.defaults['delete_timeout'])
+
+    def test_session_options_from_settings(self):
+        adapter = pownyapi.PownySession.get_session().get_adapter("http://localhost")
+        self.assertEqual(adapter._pool_maxsize, 3)
+        self.assertEqual(adapter.max_retries.total, 5)
+        self.assertEqual(pownyapi.PownySession.get_option('timeout'), pownyapi.PownySession.defaults['timeout'])
+
+
+class TestBoundedMap(unittest.TestCase):
+    def test_order_and_limit(self):
+        lock = threading.Lock()
+        state = {'running': 0, 'max_running': 0}
+
+        def work(item):
+            with lock:
+                state['running'] += 1
+                state['max_running'] = max(state['max_running'], state['running'])
+            # Calls hold their slots for a while, so they overlap if the limit allows it
+            time.sleep(0.01)
+            with lock:
+                state['running'] -= 1
+            return item * 2
+
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            results = [(item, future.result()) for (item, future) in util.bounded_map(executor, work, range(30), 3)]
+
+        self.assertEqual(results, [(item, item * 2) for item in range(30)])
+        self.assertEqual(state['max_running'], 3)
+
+
+class TestEventsReader(unittest.TestCase):
+    def test_ndjson(self):
+        stream = io.StringIO('{"host": "a"}\n\n{"host": "b"}\n')
+        reader = events.iter_events(stream)
+        self.assertEqual(next(reader), {'host': 'a'})
+        self.assertEqual(list(reader), [{'host': 'b'}])
+
+    def test_json_document(self):
+        stream = io.StringIO('[\n {"host": "a"},\n {"host": "b"}\n]')
+        self.assertEqual(list(events.iter_events(stream)), [{'host': 'a'}, {'host': 'b'}])
+
+    def test_broken_line(self):
+        stream = io.StringIO('{"host": "a"}\n{"host": \n')
+        with self.assertRaises(events.EventParseError):
+            list(events.iter_events(stream))
+
+
+class TestHandlerIndex(unittest.TestCase):
+    @staticmethod
+    def _check_match(handler, event):
+        return handler(event)
+
+    def test_same_as_scan(self):
+        calls = []
+
+        def by_host(event):
+            calls.append(event['host'])
+            return event['host'] == 'foo'
+
+        handlers = {
+            'by_host': by_host,
+            'by_host_and_status': lambda event: event['host'] == 'foo' and event['status'] == 'CRIT',
+            'whole_event': lambda event: len(event) > 2,
+        }
+        index = matchindex.HandlerIndex(handlers, self._check_match)
+        events_list = [{'host': host, 'status': status} for host in ('foo', 'bar') * 5 for status in ('OK', 'CRIT')]
+        expected = [index.scan(event) for event in events_list]
+        del calls[:]
+
+        self.assertEqual([index.match(event) for event in events_list], expected)
+        # Learning evaluation plus one evaluation per distinct host
+        self.assertEqual(len(calls), 3)
+
+    def test_verify(self):
+        state = {'value': True}
+        handlers = {'impure': lambda event: state['value'] and event['host'] == 'foo'}
+        index = matchindex.HandlerIndex(handlers, self._check_match, verify=True)
+        self.assertEqual(index.match({'host': 'foo'}), ['impure'])
+        state['value'] = False
+        self.assertEqual(index.match({'host': 'foo'}), [])
+
+
+class TestClusterConfigCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.patcher = mock.patch.object(cache, 'CACHE_DIR', self.tmp_dir.name)
+        self.patcher.start()
+        self.api_url = "http://localhost"
+
+    def tearDown(self):
+        self.patcher.stop()
+        self.tmp_dir.cleanup()
+
+    def test_revalidate(self):
+        with mock.patch.object(pownyapi, 'revalidate_cluster_config',
+                               return_value=({'core': {}}, '"v1"', None)) as revalidate:
+            self.assertEqual(cache.get_cluster_config(self.api_url, ttl=3600), {'core': {}})
+            self.assertEqual(cache.get_cluster_config(self.api_url, ttl=3600), {'core': {}})
+            self.assertEqual(revalidate.call_count, 1)
+
+            revalidate.return_value = (None, '"v1"', None)
+            self.assertEqual(cache.get_cluster_config(self.api_url, ttl=0), {'core': {}})
+            revalidate.assert_called_with(self.api_url, '"v1"', None)
+
+    def test_offline(self):
+        with self.assertRaises(cache.CacheError):
+            cache.get_cluster_config(self.api_url, ttl=0, offline=True)
+        cache.store(cache.CLUSTER_CONFIG, self.api_url, {'core': {}})
+        self.assertEqual(cache.get_cluster_config(self.api_url, ttl=0, offline=True), {'core': {}})
+        self.assertEqual(cache.purge(), 1)
+
+
+class TestRulesBytecodeCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.rules_path = os.path.join(self.tmp_dir.name, 'rules')
+        os.mkdir(self.rules_path)
+        with open(os.path.join(self.rules_path, 'powny_cached_rule.py'), 'w') as rule:
+            rule.write("VALUE = 42\n")
+        self.patcher = mock.patch.object(cache, 'CACHE_DIR', os.path.join(self.tmp_dir.name, 'cache'))
+        self.patcher.start()
+        sys.path.insert(0, self.rules_path)
+
+    def tearDown(self):
+        sys.path.remove(self.rules_path)
+        sys.modules.pop('powny_cached_rule', None)
+        self.patcher.stop()
+        self.tmp_dir.cleanup()
+
+    def _import_rule(self):
+        sys.modules.pop('powny_cached_rule', None)
+        with rulecache.bytecode_cache(self.rules_path):
+            return __import__('powny_cached_rule')
+
+    def test_compiled_once(self):
+        self.assertEqual(self._import_rule().VALUE, 42)
+        self.assertEqual(len(list(rulecache.iter_entries())), 1)
+        with mock.patch.object(rulecache._CachingLoader, 'source_to_code', side_effect=AssertionError):
+            self.assertEqual(self._import_rule().VALUE, 42)
+
+
+class TestPreflight(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        package = os.path.join(self.tmp_dir.name, 'preflight_rules')
+        os.mkdir(package)
+        for (name, source) in (('__init__', ''), ('good', 'VALUE = 1\n'), ('broken', 'raise ValueError\n')):
+            with open(os.path.join(package, name + '.py'), 'w') as rule:
+                rule.write(source)
+        self.config = {'rules-path': self.tmp_dir.name, 'cache': {'rules_bytecode': False}}
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_preflight(self):
+        with mock.patch.object(checker, '_merge_cluster_config', side_effect=lambda config, offline: config), \
+                mock.patch.object(checker.apps, 'init'):
+            with self.assertRaises(checker.PownyCheckerException):
+                checker.preflight(self.config, workers=2)
+            os.remove(os.path.join(self.tmp_dir.name, 'preflight_rules', 'broken.py'))
+            times = checker.preflight(self.config, workers=2)
+        self.assertEqual(sorted(times), ['preflight_rules', 'preflight_rules.good'])
+
+
+class TestShell(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        settings.Settings.config = {}
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+        settings.Settings.config = {}
+
+    def test_commands(self):
+        with open(os.path.join(self.tmp_dir.name, 'pownyrules.yaml'), 'w') as repo_config:
+            repo_config.write('powny_api_url: http://localhost\n')
+        jobs = [('1', {'url': 'http://localhost/v1/jobs/1'}), ('2', {'url': 'http://localhost/v1/jobs/2'})]
+        with mock.patch.object(client.logging.config, 'dictConfig') as configure, \
+                mock.patch.object(pownyapi, 'iter_jobs', side_effect=lambda powny_server: iter(jobs)):
+            result = CliRunner().invoke(client.cli, ['-w', self.tmp_dir.name, 'shell'],
+                                        input='job list\nbogus\njob list --count\nexit\njob list\n')
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn("1\n2\n", result.output)
+        self.assertIn("No such command", result.output)
+        self.assertTrue(result.output.rstrip().endswith("2"))
+        # Settings are loaded only by the shell itself
+        self.assertEqual(configure.call_count, 1)
+
+    def test_rules_loaded_once(self):
+        rule_path = os.path.join(self.tmp_dir.name, 'rule.py')
+        with open(rule_path, 'w') as rule:
+            rule.write("VALUE = 1\n")
+        config = {'rules-path': self.tmp_dir.name}
+        with mock.patch.object(checker, '_loaded_rules', None), \
+                mock.patch.object(checker, '_load_rules', return_value=({'handlers': {}}, {})) as load, \
+                mock.patch.object(checker, '_reload_modules') as reload_modules, \
+                mock.patch.object(checker, '_collect_exposed', return_value={'handlers': {'rule.on_event': None}}):
+            self.assertEqual(checker.load_rules(config), ({'handlers': {}}, {}))
+            self.assertEqual(checker.load_rules(config), ({'handlers': {}}, {}))
+            self.assertFalse(reload_modules.called)
+            with open(rule_path, 'a') as rule:
+                rule.write("VALUE = 2\n")
+            exposed, _ = checker.load_rules(config)
+            self.assertEqual(exposed, {'handlers': {'rule.on_event': None}})
+            self.assertEqual(reload_modules.call_args[0][1], {rule_path})
+            self.assertEqual(load.call_count, 1)
+            with self.assertRaises(checker.PownyCheckerException):
+                checker.load_rules({'rules-path': os.path.join(self.tmp_dir.name, 'other')})
+
+
+class TestWatcher(unittest.TestCase):
+    def test_polling_changes(self):
+        with tempfile.TemporaryDirectory() as root:
+            rule_path = os.path.join(root, 'rule.py')
+
+            def write_rule(_):
+                with open(rule_path, 'a') as rule:
+                    rule.write("# change\n")
+
+            with mock.patch.object(watcher, 'inotify_simple', None), \
+                    mock.patch.object(watcher._PollingWaiter, '__call__', write_rule):
+                changes = watcher.iter_changes(root)
+                self.assertEqual(next(changes), {rule_path})
+                self.assertEqual(next(changes), {rule_path})
+
+
+class TestReplay(unittest.TestCase):
+    def setUp(self):
+        self.now = 100.0
+        self.sent = []
+
+    def clock(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+    def send(self, event):
+        if event.get('fail'):
+            raise pownyapi.PownyAPIException("Can't post new event.")
+        self.sent.append((event['n'], round(self.now - 100, 3)))
+
+    def _replay(self, events, **kwargs):
+        return replay.replay(events, self.send, clock=self.clock, sleep=self.sleep, **kwargs)
+
+    def test_parse_time(self):
+        self.assertEqual(replay.parse_time(10), 10.0)
+        self.assertEqual(replay.parse_time('1970-01-01T00:01:00.5Z'), 60.5)
+        self.assertEqual(replay.parse_time('1970-01-01 00:00:10'), 10.0)
+        with self.assertRaises(replay.ReplayError):
+            replay.parse_time('yesterday')
+
+    def test_speed(self):
+        events = [{'n': 0, 'timestamp': 50}, {'n': 1, 'timestamp': 51}, {'n': 2},
+                  {'n': 3, 'timestamp': 50.5}, {'n': 4, 'timestamp': 54}]
+        self._replay(events, speed=2)
+        # Events without time or with earlier time are sent at once
+        self.assertEqual(self.sent, [(0, 0), (1, 0.5), (2, 0.5), (3, 0.5), (4, 2)])
+
+    def test_rate(self):
+        events = [{'n': number, 'timestamp': 0} for number in range(5)]
+        self._replay(events, rate=10, burst=2)
+        self.assertEqual(self.sent, [(0, 0), (1, 0), (2, 0.1), (3, 0.2), (4, 0.3)])
+
+    def test_stats(self):
+        stats = self._replay([{'n': 0}, {'n': 1, 'fail': True}, {'n': 2}], concurrency=2)
+        self.assertEqual((stats['events'], stats['errors'], stats['p50']), (3, 1, 0))
+
+    def test_live_stats(self):
+        order = []
+
+        def send(event):
+            order.append(event['n'])
+            if event.get('fail'):
+                raise pownyapi.PownyAPIException("Can't post new event.")
+
+        events = [{'n': 0, 'timestamp': 0, 'fail': True}, {'n': 1, 'timestamp': 0.2}, {'n': 2, 'timestamp': 0.3}]
+        with mock.patch.object(replay.logger, 'error', side_effect=lambda *args: order.append('error')), \
+                mock.patch.object(replay.logger, 'info') as info:
+            replay.replay(events, send, concurrency=3, stats_interval=0.05)
+        # The error is logged when the call ends, not when later events are sent
+        self.assertEqual(order, [0, 'error', 1, 2])
+        # Stats are reported by time, also while nothing is sent
+        self.assertGreaterEqual(sum(1 for call in info.call_args_list if call[0][0].startswith("Replayed")), 3)
+
+    def test_reservoir(self):
+        reservoir = replay.Reservoir(100)
+        for value in range(10000):
+            reservoir.add(value)
+        self.assertEqual((reservoir.count, len(reservoir.samples)), (10000, 100))
+        p50, p99 = reservoir.get_percentiles((0.5, 0.99))
+        self.assertTrue(2000 < p50 < 8000 < p99)
+
+    def test_command(self):
+        settings.Settings.config = {'powny_api_url': "http://localhost"}
+        events = '{"host": "a", "service": "b", "status": "CRIT", "timestamp": 0}\n' * 3
+        with mock.patch.object(pownyapi, 'send_event', return_value={}) as send_event:
+            result = CliRunner().invoke(client.replay_events, ['-', '--speed', '0', '--rate', '1000'], input=events)
+        self.assertEqual(result.exit_code, 0)
+        self.assertEqual(send_event.call_count, 3)
+
+
+class TestCasStorage(unittest.TestCase):
+    def _check_semantics(self, storage):
+        with self.assertRaises(CasNoValueError):
+            storage.replace_value('foo')
+        old, write_ok = storage.replace_value('foo', value=1, version=2, default=None)
+        self.assertEqual((old.value, write_ok), (None, True))
+        with self.assertRaises(CasVersionError):
+            storage.replace_value('foo', value=0, version=1)
+        old, write_ok = storage.replace_value('foo', value=0, version=1, fatal_write=False)
+        self.assertEqual((old.value, old.version, write_ok), (1, 2, False))
+        self.assertEqual(storage.get_value('foo').value, 1)
+
+    def test_memory(self):
+        self._check_semantics(cas.make_storage('memory'))
+
+    def test_sqlite_snapshot(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            storage = cas.make_storage('sqlite:' + os.path.join(tmp_dir, 'cas.db'))
+            self._check_semantics(storage)
+            snapshot = storage.dump()
+
+            reopened = cas.make_storage('sqlite:' + os.path.join(tmp_dir, 'cas.db'))
+            self.assertEqual(reopened.get_value('foo').value, 1)
+
+            memory = cas.make_storage('memory')
+            memory.load(snapshot)
+            self.assertEqual(memory.dump(), snapshot)
+
+    def _watch(self, storage):
+        with mock.patch.object(checker, 'load_rules', return_value=({'handlers': {}}, {})), \
+                mock.patch.object(checker, '_merge_cluster_config', side_effect=lambda config, offline: config), \
+                mock.patch.object(checker, '_reload_modules'), \
+                mock.patch.object(checker, '_collect_exposed', return_value={'handlers': {}}), \
+                mock.patch.object(checker.watcher, 'iter_changes', return_value=iter([{'rule.py'}])), \
+                mock.patch.object(storage, 'load', wraps=storage.load) as load:
+            # The second wait for changes ends the loop
+            with self.assertRaises(StopIteration):
+                checker.watch({'rules-path': '.'}, [{'host': 'a'}], cas_storage=storage,
+                              cas_snapshot={'foo': {'value': 1, 'version': 1, 'stored': None}})
+        return load.call_count
+
+    def test_watch_keeps_persistent_state(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            self.assertEqual(self._watch(cas.make_storage('sqlite:' + os.path.join(tmp_dir, 'cas.db'))), 1)
+        self.assertEqual(self._watch(cas.make_storage('memory')), 2)
+
+    def test_dump_from_workers(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            dump_path = os.path.join(tmp_dir, 'cas.json')
+            with mock.patch.object(client, '_check_rules_repo'), mock.patch.object(checker, 'check') as check:
+                result = CliRunner().invoke(client.execute, ['h', 's', 'CRIT', '-j', '2', '--cas-dump', dump_path])
+                self.assertEqual(result.exit_code, 2)
+                self.assertIn("--cas-dump", result.output)
+                self.assertFalse(check.called)
+
+                result = CliRunner().invoke(client.execute, ['h', 's', 'CRIT', '-j', '2', '--cas', 'shared',
+                                                             '--cas-dump', dump_path])
+                self.assertEqual(result.exit_code, 0)
+                self.assertTrue(check.called)
+
+
+class TestJobLogs(unittest.TestCase):
+    @staticmethod
+    def _page(start, count):
+        resp = mock.Mock()
+        resp.json.return_value = {'_scroll_id': 'scroll',
+                                  'hits': {'hits': [{'_source': {'n': n}} for n in range(start, start + count)]}}
+        return resp
+
+    def _get_pages(self, first, scrolled, **kwargs):
+        with mock.patch.object(pownyapi.PownySession, 'post', return_value=first), \
+                mock.patch.object(pownyapi.PownySession, 'get', side_effect=scrolled) as get, \
+                mock.patch.object(pownyapi.PownySession, 'delete') as delete:
+            pages = list(elasticapi.iter_job_logs('http://localhost', elasticapi.JobLogsQuery(['job']), **kwargs))
+        self.assertTrue(delete.called)
+        return [[hit['_source']['n'] for hit in page] for page in pages], get.call_count
+
+    def test_pages(self):
+        pages, requests = self._get_pages(self._page(0, 2), [self._page(2, 2), self._page(4, 1)], page_size=2)
+        self.assertEqual(pages, [[0, 1], [2, 3], [4]])
+        self.assertEqual(requests, 2)
+
+    def test_limit(self):
+        pages, requests = self._get_pages(self._page(0, 2), [self._page(2, 2)], limit=3, page_size=2)
+        self.assertEqual(pages, [[0, 1], [2]])
+        self.assertEqual(requests, 1)
+
+    def test_follow(self):
+        def page(*hits):
+            resp = mock.Mock()
+            resp.json.return_value = {'hits': {'hits': [{'_id': id, '_source': {'@timestamp': timestamp}}
+                                                        for (id, timestamp) in hits]}}
+            return resp
+
+        first = page(('a', '2015-01-01T10:00:00.000000'), ('b', '2015-01-02T10:00:00.000000'))
+        polls = [page(('b', '2015-01-02T10:00:00.000000')), page(('b', '2015-01-02T10:00:00.000000')),
+                 page(('b', '2015-01-02T10:00:00.000000'), ('c', '2015-01-02T10:00:00.000000'),
+                      ('d', '2015-01-02T11:00:00.000000'))]
+        with mock.patch.object(pownyapi.PownySession, 'post', side_effect=[first] + polls) as post, \
+                mock.patch.object(pownyapi.PownySession, 'delete'), \
+                mock.patch.object(elasticapi.time, 'sleep') as sleep, \
+                mock.patch.object(elasticapi, 'MAX_INDICES', 10000):
+            query = elasticapi.JobLogsQuery(['job'], index_pattern='logs-%Y.%m.%d')
+            pages = elasticapi.follow_job_logs('http://localhost', query, interval=1, max_interval=3)
+            ids = [[hit['_id'] for hit in hits] for hits in itertools.islice(pages, 2)]
+
+        self.assertEqual(ids, [['a', 'b'], ['c', 'd']])
+        self.assertEqual([args[0] for (args, _) in sleep.call_args_list], [1, 2])
+        self.assertTrue(post.call_args_list[0][0][0].startswith('http://localhost/logs-*/_search'))
+        self.assertTrue(post.call_args[0][0].startswith('http://localhost/logs-2015.01.02,logs-2015.01.03,'))
+        conditions = json.loads(post.call_args[1]['data'])['query']['constant_score']['filter']['bool']['must']
+        self.assertEqual(conditions, [{'terms': {'job_id.raw': ['job']}},
+                                      {'range': {'@timestamp': {'gte': '2015-01-02T10:00:00.000000'}}}])
+
+    def test_follow_tail(self):
+        def page(*hits):
+            resp = mock.Mock()
+            resp.json.return_value = {'hits': {'hits': [{'_id': id, '_source': {'@timestamp': timestamp}}
+                                                        for (id, timestamp) in hits]}}
+            return resp
+
+        latest = page(('c', '2015-01-02T11:00:00.000000'), ('b', '2015-01-02T10:00:00.000000'))
+        poll = page(('c', '2015-01-02T11:00:00.000000'), ('d', '2015-01-02T12:00:00.000000'))
+        with mock.patch.object(pownyapi.PownySession, 'post', side_effect=[latest, poll]) as post, \
+                mock.patch.object(elasticapi.time, 'sleep'):
+            pages = elasticapi.follow_job_logs('http://localhost', elasticapi.JobLogsQuery(['job']), limit=2)
+            ids = [[hit['_id'] for hit in hits] for hits in itertools.islice(pages, 2)]
+
+        self.assertEqual(ids, [['b', 'c'], ['d']])
+        body = json.loads(post.call_args_list[0][1]['data'])
+        self.assertEqual((body['size'], body['sort']), (2, [{'@timestamp': {'order': 'desc'}}]))
+
+    def test_default_job_id_field(self):
+        # Job ids are matched exactly, the field of the default config must not be analyzed
+        import yaml
+        with open(settings.Settings.get_default_config_path()) as default_config:
+            job_id_field = yaml.load(default_config)['elastic_job_id_field']
+        self.assertEqual(job_id_field, 'job_id.raw')
+        body = elasticapi.JobLogsQuery(['job'], job_id_field=job_id_field, group=True).get_body(10)
+        conditions = body['query']['constant_score']['filter']['bool']['must']
+        self.assertEqual(conditions, [{'terms': {'job_id.raw': ['job']}}])
+        self.assertEqual(body['sort'][0], {'job_id.raw': {'order': 'asc'}})
+
+    def test_indices(self):
+        since = datetime(2015, 1, 30, 23, 0)
+        self.assertEqual(elasticapi.get_indices('logs-%Y.%m.%d', since, datetime(2015, 2, 1, 1, 0)),
+                         ['logs-2015.01.30', 'logs-2015.01.31', 'logs-2015.02.01'])
+        self.assertEqual(elasticapi.get_indices('logs-%Y.%m', since, datetime(2015, 2, 1)),
+                         ['logs-2015.01', 'logs-2015.02'])
+        self.assertEqual(elasticapi.get_indices('logs-%Y.%m.%d', since, datetime(2016, 1, 1)), ['logs-*'])
+
+    def test_same_as_tabloid(self):
+        rows = [['node{}'.format(n % 3), 'worker', '01 Jan 00:00:{:02d}'.format(n), ('INFO', 'DEBUG')[n % 2],
+                 'message ' * n] for n in range(30)]
+        tables = []
+        for table in (tabloid.FormattedTable(width=100), util.StreamingTable(width=100, sample_size=len(rows))):
+            table.add_column('Role')
+            table.add_column('Node', util.Colorfull.get_node)
+            table.add_column('Time', util.Colorfull.timestamp)
+            table.add_column('Level', util.Colorfull.get_level)
+            table.add_column('Message')
+            tables.append(table)
+        for row in rows:
+            tables[0].add_row(row)
+        self.assertEqual('\n'.join(tables[0].get_table()), '\n'.join(tables[1].iter_page(rows)))
+
+    def test_format_record(self):
+        fields = {'@timestamp': '2015-03-07T21:05:09.123456', 'level': 'INFO', 'node': 'node01-worker-1',
+                  'msg': 'Step %d', 'args': [1]}
+        self.assertEqual(client._format_log_record(fields, False),
+                         ['node01', 'worker', '07 Mar 21:05:09', 'INFO', 'Step 1'])
+        self.assertIsNone(client._format_log_record(dict(fields, level='DEBUG'), False))
+
+    def test_many_jobs(self):
+        def hit(number, job_id):
+            return {'_source': {'job_id': job_id, '@timestamp': '2015-01-01T00:00:0{}.000000'.format(number),
+                                'level': 'INFO', 'node': 'node01-worker', 'msg': 'Record {}'.format(number)}}
+
+        settings.Settings.config = {'elastic_url': 'http://localhost'}
+        send_event_output = 'job-2 rules.test.handler\njob-1 rules.test.handler\n'
+        with mock.patch.object(elasticapi, 'iter_job_logs',
+                               return_value=[[hit(0, 'job-1'), hit(1, 'job-2'), hit(2, 'job-1')]]) as iter_job_logs:
+            result = CliRunner().invoke(client.job, ['logs', 'job-1', '--from-event', '-'], input=send_event_output)
+        self.assertEqual(result.exit_code, 0)
+        query = iter_job_logs.call_args[0][1]
+        self.assertEqual(query.job_ids, ['job-1', 'job-2'])
+        self.assertEqual(json.dumps(query.get_body(10)).count('job_id'), 1)  # One `terms` filter
+        self.assertEqual([line.split()[0] for line in result.output.splitlines()[1:]], ['job-1', 'job-2', 'job-1'])
+
+        with mock.patch.object(elasticapi, 'iter_job_logs',
+                               return_value=[[hit(0, 'job-1'), hit(2, 'job-1')], [hit(1, 'job-2')]]):
+            result = CliRunner().invoke(client.job, ['logs', 'job-1', 'job-2', '--group'])
+        titles = [line for line in result.output.splitlines() if line.startswith('Job ')]
+        self.assertEqual(titles, ['Job job-1:', 'Job job-2:'])
+
+    def test_group_by_configured_field(self):
+        def hit(number, job_id):
+            return {'_source': {'task': {'id': job_id}, '@timestamp': '2015-01-01T00:00:0{}.000000'.format(number),
+                                'level': 'INFO', 'node': 'node01-worker', 'msg': 'Record {}'.format(number)}}
+
+        settings.Settings.config = {'elastic_url': 'http://localhost', 'elastic_job_id_field': 'task.id.keyword'}
+        with mock.patch.object(elasticapi, 'iter_job_logs',
+                               return_value=[[hit(0, 'job-1'), hit(2, 'job-1')], [hit(1, 'job-2')]]) as iter_job_logs:
+            result = CliRunner().invoke(client.job, ['logs', 'job-1', 'job-2', '--group'])
+        self.assertEqual(iter_job_logs.call_args[0][1].job_id_field, 'task.id.keyword')
+        titles = [line for line in result.output.splitlines() if line.startswith('Job ')]
+        self.assertEqual(titles, ['Job job-1:', 'Job job-2:'])
+
+    def test_streaming_table(self):
+        table = util.StreamingTable(width=80)
+        table.add_column('Name')
+        table.add_column('Value')
+        first = list(table.iter_page([['a', 1], ['bb', 2]]))
+        self.assertEqual(len(first), 3)  # Header and rows
+        self.assertEqual(list(table.iter_page([])), [])
+        second = list(table.iter_page([['c', 3]]))
+        self.assertEqual(len(second), 1)
+        self.assertEqual(len(second[0]), len(first[1]))
+
+
+class TestGitPush(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.repo = os.path.join(self.tmp_dir.name, 'rules')
+        self.remotes = [os.path.join(self.tmp_dir.name, 'powny{}.git'.format(n)) for n in range(3)]
+        for remote in self.remotes:
+            gitapi._execute_git_command(['init', '-q', '--bare', remote], None, "Can't init")
+        gitapi._execute_git_command(['init', '-q', self.repo], None, "Can't init")
+        gitapi._execute_git_command(['-c', 'user.name=test', '-c', 'user.email=test@localhost', 'commit', '-q',
+                                     '--allow-empty', '-m', 'init'], self.repo, "Can't commit")
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_push_to_remotes(self):
+        missing = os.path.join(self.tmp_dir.name, 'missing.git')
+        branch = gitapi._get_current_branch(self.repo)
+        failed = gitapi.push_to_remotes(self.repo, self.remotes + [missing], branch, False, concurrency=2)
+        self.assertEqual(list(failed), [missing])
+        for remote in self.remotes:
+            self.assertEqual(gitapi._execute_git_command(['--git-dir', remote, 'rev-parse', 'master'], None,
+                                                         "Can't get HEAD").strip(), gitapi.get_head(self.repo))
+
+    def test_upload_only_changes(self):
+        origin = os.path.join(self.tmp_dir.name, 'origin.git')
+        gitapi._execute_git_command(['init', '-q', '--bare', origin], None, "Can't init")
+        gitapi._execute_git_command(['remote', 'add', 'origin', origin], self.repo, "Can't add remote")
+        settings.Settings.config = {'powny_git_remotes': self.remotes}
+        rules_info = {'head': None, 'errors': {}, 'exposed': {'methods': [], 'handlers': []}}
+
+        def set_header(_, head):
+            rules_info['head'] = head
+
+        checked = []
+
+        def upload():
+            with mock.patch.object(pownyapi, 'get_rules_info', return_value=rules_info), \
+                    mock.patch.object(pownyapi, 'set_header', side_effect=set_header), \
+                    mock.patch.object(gitapi, '_execute_git_command', wraps=gitapi._execute_git_command) as execute:
+                gitapi.upload('http://localhost', self.repo, False,
+                              preflight=lambda: checked.append(gitapi.get_head(self.repo)))
+            return [call[0][0][0] for call in execute.call_args_list]
+
+        self.assertEqual(upload().count('push'), 4)
+        self.assertEqual(rules_info['head'], gitapi.get_head(self.repo))
+        self.assertNotIn('push', upload())
+        # Nothing is pushed, so the rules are not checked
+        self.assertEqual(checked, [gitapi.get_head(self.repo)])
+
+        # A new commit in origin is pulled, and pushed to the Powny remotes only
+        clone = os.path.join(self.tmp_dir.name, 'clone')
+        gitapi._execute_git_command(['clone', '-q', origin, clone], None, "Can't clone")
+        gitapi._execute_git_command(['-c', 'user.name=test', '-c', 'user.email=test@localhost', 'commit', '-q',
+                                     '--allow-empty', '-m', 'next'], clone, "Can't commit")
+        gitapi._execute_git_command(['push', '-q', 'origin', 'HEAD'], clone, "Can't push")
+        commands = upload()
+        self.assertEqual((commands.count('pull'), commands.count('push')), (1, 3))
+        self.assertEqual(rules_info['head'], gitapi.get_head(clone))
+        # The pulled tree is checked
+        self.assertEqual(checked[-1], gitapi.get_head(clone))
+
+    def test_policy(self):
+        self.assertEqual([gitapi.is_policy_met(policy, 2, 4) for policy in gitapi.PUSH_POLICIES],
+                         [False, False, True])
+        self.assertEqual([gitapi.is_policy_met(policy, 3, 4) for policy in gitapi.PUSH_POLICIES],
+                         [False, True, True])
+        self.assertEqual([gitapi.is_policy_met(policy, 0, 1) for policy in gitapi.PUSH_POLICIES],
+                         [False, False, False])
+
+
+class TestGitRepo(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.repo = os.path.realpath(self.tmp_dir.name)
+        self._git('init', '-q')
+        for name in ('a.py', 'b.py', os.path.join('rules', 'c.py')):
+            os.makedirs(os.path.dirname(os.path.join(self.repo, name)), exist_ok=True)
+            with open(os.path.join(self.repo, name), 'w') as source:
+                source.write('# {}\n'.format(name))
+        self._git('add', '.')
+        self._git('-c', 'user.name=test', '-c', 'user.email=test@localhost', 'commit', '-q', '-m', 'init')
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def _git(self, *args):
+        return gitapi._execute_git_command(args, self.repo, "Git failed").strip()
+
+    def _check_head(self):
+        branch, head = gitrepo.read_head(self.repo)
+        self.assertEqual(branch, self._git('rev-parse', '--abbrev-ref', 'HEAD'))
+        self.assertEqual(head, self._git('rev-parse', 'HEAD'))
+
+    def test_head(self):
+        self._check_head()
+        self._git('pack-refs', '--all')
+        self._check_head()
+        self._git('checkout', '-q', '--detach')
+        self.assertEqual(gitapi._get_current_branch(self.repo), 'HEAD')
+        self.assertEqual(gitrepo.find_root(os.path.join(self.repo, 'rules')), self.repo)
+
+    def test_clean_blobs(self):
+        # Files written within the index mtime are racily clean, git status refreshes the index
+        os.utime(os.path.join(self.repo, '.git', 'index'), (2 ** 31, 2 ** 31))
+        with open(os.path.join(self.repo, 'b.py'), 'a') as source:
+            source.write('# changed\n')
+        for version in ('2', '4'):
+            self._git('update-index', '--index-version', version)
+            os.utime(os.path.join(self.repo, '.git', 'index'), (2 ** 31, 2 ** 31))
+            blobs = gitrepo.get_clean_blobs(self.repo)
+            expected = {}
+            for line in self._git('ls-files', '--stage', 'a.py', 'rules/c.py').splitlines():
+                info, name = line.split('\t')
+                expected[os.path.join(self.repo, name)] = info.split()[1]
+            self.assertEqual(blobs, expected)
+
+
+class TestStartup(unittest.TestCase):
+    def test_lazy_imports(self):
+        # Modules of the commands must not be imported with the CLI itself, it is checked in a clean interpreter
+        heavy = ('requests', 'yaml', 'tabloid', 'colorama', 'powny', 'pkg_resources', 'webbrowser')
+        code = ('import sys; loaded = set(sys.modules); import pownycli.client; '
+                'print(" ".join(sorted((set(sys.modules) - loaded) & set({!r}))))'.format(heavy))
+        output = subprocess.check_output([sys.executable, '-c', code], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                         universal_newlines=True)
+        self.assertEqual(output.strip(), '')